@@ -0,0 +1,59 @@
+"""
+Compare the transform length, memory of the spectra and time of the pairwise stage
+of align_bundles for each fft_length policy on the bundled datasets.
+
+Run it from anywhere with
+
+    python benchmarks/bench_fft_length.py
+"""
+
+import numpy as np
+
+from pathlib import Path
+from time import perf_counter
+
+from dpr.register import get_fft_length, get_ffts, get_shifts_from_ffts, pair_indices
+from dpr.utils import strip_header
+
+datasets = Path(__file__).parents[1] / Path('datasets')
+
+
+def load(fname):
+    if fname.startswith('af_left'):
+        bundles, _ = strip_header(datasets / fname)
+    else:
+        bundles = np.loadtxt(datasets / fname)
+
+    bundles[bundles == 0] = np.nan
+    return bundles
+
+
+def bench(bundles, fft_length, repeats=3):
+    n = get_fft_length(bundles.shape[1], fft_length=fft_length)
+    rows, cols = pair_indices(len(bundles), mode='half')
+
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter()
+        ffts = get_ffts(bundles, fft_length=n)
+        shifts = get_shifts_from_ffts(ffts, rows, cols, n=n)
+        timings.append(perf_counter() - start)
+
+    return n, ffts.nbytes, min(timings), shifts
+
+
+def main():
+    print(f'{"dataset":<20} {"policy":<6} {"length":>6} {"spectra (kB)":>12} {"time (s)":>9} {"max diff":>9}')
+
+    for fname in ['bundles.txt', 'bundles_cut.txt', 'af_left_AFD.txt']:
+        bundles = load(fname)
+        _, _, _, reference = bench(bundles, 'pow2', repeats=1)
+
+        for policy in ['pow2', 'fast']:
+            n, nbytes, timing, shifts = bench(bundles, policy)
+            diff = np.max(np.abs(shifts - reference))
+            print(f'{fname:<20} {policy:<6} {n:>6} {nbytes / 1024:>12.1f} {timing:>9.3f} {diff:>9.2g}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Time how long it takes to start the dpr scripts and import the modules of dpr in a fresh interpreter,
+and list which of the slow to import modules (matplotlib, scipy.ndimage, ...) got loaded on the way.
+
+Run it from anywhere with
+
+    python benchmarks/bench_startup.py
+
+With --max-seconds, it exits with an error if importing the dpr script takes longer than that,
+which can be used to catch a slow import sneaking back in.
+"""
+
+import argparse
+import subprocess
+import sys
+
+from time import perf_counter
+
+heavy = ['matplotlib', 'mpl_toolkits', 'scipy.ndimage', 'scipy.fft']
+
+statements = {'python': 'pass',
+              'numpy': 'import numpy',
+              'dpr.utils': 'from dpr.utils import strip_header',
+              'dpr.register': 'import dpr.register',
+              'dpr script': 'import dpr.scripts.dpr',
+              'dpr_make_fancy_graph script': 'import dpr.scripts.dpr_make_fancy_graph'}
+
+
+def bench(statement, repeats=5):
+    code = f'{statement}\nimport sys\nprint(",".join(name for name in {heavy} if name in sys.modules))'
+
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter()
+        process = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True)
+        timings.append(perf_counter() - start)
+
+    return min(timings), process.stdout.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float)
+    args = parser.parse_args()
+
+    print(f'{"import":<30} {"time (s)":>9}  heavy modules loaded')
+
+    for name, statement in statements.items():
+        timing, loaded = bench(statement, repeats=args.repeats)
+        print(f'{name:<30} {timing:>9.3f}  {loaded}')
+
+        if name == 'dpr script':
+            script_timing = timing
+
+    if args.max_seconds is not None and script_timing > args.max_seconds:
+        sys.exit(f'Importing the dpr script took {script_timing:.3f} s, more than {args.max_seconds} s')
+
+
+if __name__ == '__main__':
+    main()
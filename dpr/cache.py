@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ShiftsCache:
+    '''
+    On disk cache of arrays, such as the spectra of get_ffts or the pairwise shifts, so that running again on the same
+    bundles with only different truncation or resampling options does not redo the expensive part.
+
+    Each array is stored as a .npy file named by a hash of the input arrays and of the parameters used to compute it,
+    and is loaded back memory mapped. Once the files take more than max_size bytes, the least recently used are removed.
+
+    path - directory where the arrays are stored, created if needed
+    max_size - size in bytes of the cache before the least recently used arrays are removed
+    '''
+
+    def __init__(self, path, max_size=2**30):
+        self.path = os.path.realpath(path)
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def make_key(name, *arrays, **params):
+        '''
+        Hash of the name, the content of the arrays and the parameters, which are sorted by name.
+        '''
+        digest = hashlib.sha256(name.encode())
+
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(f'{array.dtype.str}{array.shape}'.encode())
+            digest.update(array.data)
+
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, f'{key}.npy')
+
+    def get(self, key):
+        '''
+        Memory mapped array stored under key or None if there is none. The array is copy on write,
+        so it can be modified without changing the cache.
+        '''
+        fname = self._fname(key)
+
+        try:
+            array = np.load(fname, mmap_mode='c')
+        except FileNotFoundError:
+            return None
+
+        # the modification time tells which array was used last
+        os.utime(fname)
+        return array
+
+    def put(self, key, array):
+        # write to a temporary file first, so that a partial array is never read back
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, array)
+
+        os.replace(tmpname, self._fname(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used arrays until the cache is below max_size, except for the one under keep.
+        '''
+        entries = []
+
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, entry in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+
+            if entry.name == f'{keep}.npy':
+                continue
+
+            try:
+                os.remove(entry.path)
+            except OSError:  # still opened elsewhere, e.g. memory mapped on windows
+                continue
+
+            total -= size
+            logger.debug(f'Removed {entry.name} from the cache')
+
+    def get_or_compute(self, name, compute, *arrays, **params):
+        '''
+        Loads the array computed from these arrays and parameters or calls compute() and stores its result.
+        '''
+        key = self.make_key(name, *arrays, **params)
+        array = self.get(key)
+
+        if array is not None:
+            logger.info(f'Loaded the {name} from the cache {self._fname(key)}')
+            return array
+
+        array = compute()
+        self.put(key, array)
+        return array
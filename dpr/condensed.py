@@ -0,0 +1,168 @@
+import numpy as np
+
+
+class CondensedShifts:
+    '''
+    Antisymmetric matrix of pairwise shifts, where shifts[j, i] = -shifts[i, j] and the diagonal is zero.
+    Only the upper triangle is stored, in the same order as scipy.spatial.distance.squareform,
+    which takes half the memory of the full matrix (or a quarter with float32).
+
+    It can be indexed like a 2D array with integers, arrays of integers which are broadcasted together
+    or a full slice, e.g. shifts[i], shifts[i, j], shifts[rows, cols] or shifts[:, cols].
+    Setting shifts[i, j] also sets shifts[j, i] to the opposite value and the diagonal always stays zero.
+
+    size - number of bundles
+    dtype - type used to store the shifts
+    data - condensed upper triangle of length size * (size - 1) / 2, the pairs (i, j) with i < j
+        sorted by i then j, or zeros if not given
+    '''
+
+    def __init__(self, size, dtype=np.float64, data=None):
+        self.size = int(size)
+        length = self.size * (self.size - 1) // 2
+
+        if data is None:
+            self.data = np.zeros(length, dtype=dtype)
+        else:
+            self.data = np.asarray(data, dtype=dtype)
+
+            if self.data.shape != (length,):
+                error = f'data should be of shape ({length},) for {self.size} bundles, but is {self.data.shape}'
+                raise ValueError(error)
+
+    @classmethod
+    def from_dense(cls, shifts, dtype=np.float64):
+        shifts = np.asarray(shifts)
+        rows, cols = np.triu_indices(len(shifts), 1)
+        return cls(len(shifts), dtype=dtype, data=shifts[rows, cols])
+
+    @property
+    def shape(self):
+        return self.size, self.size
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def _locate(self, key):
+
+        if not isinstance(key, tuple):
+            key = key, slice(None)
+
+        if len(key) != 2:
+            raise IndexError(f'Only 2D indexing is supported, but got {len(key)} indexes')
+
+        for idx in key:
+            if isinstance(idx, slice) and idx != slice(None):
+                raise IndexError('Only full slices are supported')
+
+        rows, cols = [np.arange(self.size) if isinstance(idx, slice) else np.asarray(idx) for idx in key]
+
+        # a full slice goes with all the indexes of the other axis, like numpy would do
+        if isinstance(key[1], slice):
+            rows = rows[..., None]
+        elif isinstance(key[0], slice) and cols.ndim > 0:
+            rows = rows[:, None]
+
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp))
+        rows = np.where(rows < 0, rows + self.size, rows)
+        cols = np.where(cols < 0, cols + self.size, cols)
+
+        if np.any((rows >= self.size) | (cols >= self.size) | (rows < 0) | (cols < 0)):
+            raise IndexError(f'Index out of bounds for {self.size} bundles')
+
+        i = np.minimum(rows, cols)
+        j = np.maximum(rows, cols)
+        diagonal = rows == cols
+        index = np.where(diagonal, 0, self.size * i - i * (i + 1) // 2 + (j - i - 1))
+        sign = np.where(rows < cols, 1., -1.)
+
+        return index, sign, diagonal
+
+    def __getitem__(self, key):
+        index, sign, diagonal = self._locate(key)
+
+        if len(self.data) == 0:
+            values = np.zeros(index.shape)
+        else:
+            values = np.where(diagonal, 0., sign * self.data[index])
+
+        if values.ndim == 0:
+            return values.item()
+        return values
+
+    def __setitem__(self, key, values):
+        index, sign, diagonal = self._locate(key)
+        values = np.broadcast_to(values, index.shape)
+        self.data[index[~diagonal]] = (sign * values)[~diagonal]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.todense().astype(dtype, copy=False) if dtype is not None else self.todense()
+
+    def todense(self):
+        dense = np.zeros(self.shape)
+        rows, cols = np.triu_indices(self.size, 1)
+        dense[rows, cols] = self.data
+        dense[cols, rows] = -self.data
+        return dense
+
+    def iter_rows(self, block_size=1024):
+        '''
+        Yields the index of the first row and a dense block of block_size rows at a time.
+        '''
+        for start in range(0, self.size, block_size):
+            rows = np.arange(start, min(start + block_size, self.size))
+            yield start, self[rows]
+
+    def iter_upper(self, block_size=1024):
+        '''
+        Yields each row i with the absolute value of shifts[i, i + 1:], which are read as a slice of data
+        block_size rows at a time, so nothing of the size of the matrix is created.
+        '''
+        for start in range(0, self.size, block_size):
+            rows = np.arange(start, min(start + block_size, self.size) + 1)
+
+            # position of shifts[i, i + 1] in data, the last one is the end of the block
+            offsets = self.size * rows - rows * (rows + 1) // 2
+            block = np.abs(self.data[offsets[0]:offsets[-1]])
+            offsets -= offsets[0]
+
+            for i, begin, end in zip(rows[:-1].tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+                yield i, block[begin:end]
+
+    def count_within(self, thresholds, block_size=1024):
+        '''
+        Number of shifts in each row which are smaller than the threshold of their column,
+        the same as np.sum(np.abs(shifts) < thresholds, axis=1) for the dense matrix.
+        '''
+        thresholds = np.broadcast_to(thresholds, (self.size,))
+
+        # the diagonal is zero
+        count = (0 < thresholds).astype(np.intp)
+
+        for i, upper in self.iter_upper(block_size=block_size):
+            # shifts[i, j] for j > i goes with the threshold of column j and shifts[j, i] with the one of column i
+            count[i] += np.count_nonzero(upper < thresholds[i + 1:])
+            count[i + 1:] += upper < thresholds[i]
+
+        return count
+
+    def max_abs(self, block_size=1024):
+        '''
+        Largest absolute shift of each row.
+        '''
+        largest = np.zeros(self.size)
+
+        for i, upper in self.iter_upper(block_size=block_size):
+            # the upper part of row i is also the column i of the rows below
+            largest[i] = np.maximum(largest[i], np.max(upper, initial=0))
+            largest[i + 1:] = np.maximum(largest[i + 1:], upper)
+
+        return largest
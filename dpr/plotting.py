@@ -0,0 +1,83 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+from matplotlib.collections import LineCollection
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+from dpr.streamlines import Streamlines
+
+
+# Actual colors I used in the manuscript
+blue = np.array([0.6093924, 0.73212757, 0.82249106])
+green = np.array([0.22953434, 0.57685998, 0.42976558])
+
+
+def colorbar(mappable):
+    ax = mappable.axes
+    fig = ax.figure
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.05)
+    return fig.colorbar(mappable, cax=cax)
+
+
+def _draw_streamlines(ax, x, y, **kwargs):
+    '''
+    Draws the streamlines of x and y, which are lists of arrays or Streamlines of a single coordinate.
+    The packed Streamlines are drawn as a single collection instead of one line per streamline.
+    '''
+
+    if not isinstance(x, Streamlines):
+        for xx, yy in zip(x, y):
+            ax.plot(xx, yy, **kwargs)
+        return
+
+    points = np.column_stack((x.points, y.points))
+    segments = np.split(points, x.offsets[1:])
+    ax.add_collection(LineCollection(segments, **kwargs))
+    ax.autoscale_view()
+
+
+def draw_fancy_graph(pval, coords1, coords2, truncated_coords1, truncated_coords2, average1, average2, coord1_label='X', coord2_label='Y',
+                     pval_threshold=1., pval_cmap='hot', mean_fiber_cmap=green, bundle_cmap=blue,
+                     shadow_cmap='gray', title=None, draw_colorbar=True):
+    '''
+    coords1, coords2, truncated_coords1, truncated_coords2 - lists of arrays of one coordinate of each streamline,
+        or Streamlines of a single coordinate such as Streamlines.column(0)
+    '''
+
+    if title is None:
+        title = 'p-values after realignment'
+
+    fig, ax = plt.subplots(1, 1, sharex='col', sharey='row', figsize=(8, 8))
+
+    # Draw the full length shadow bundle
+    _draw_streamlines(ax, coords1, coords2, color=shadow_cmap, alpha=0.1, zorder=1)
+
+    # Draw the original coord, but truncated between rois
+    _draw_streamlines(ax, truncated_coords1, truncated_coords2, color=bundle_cmap, alpha=0.3, zorder=2)
+
+    # Draw the mean coord
+    x = average1
+    y = average2
+    ax.plot(x, y, color=mean_fiber_cmap, zorder=5)
+
+    # We resample the pvals because the coords may be at the tracking stepsize and the final results at the voxel resolution
+    old = np.arange(len(pval)) / len(pval)
+    new = np.arange(len(x)) / len(x)
+    pval_resampled = np.interp(new, old, pval)
+
+    # This makes everything above the threshold invisible on the final graph
+    pval_resampled[pval_resampled > pval_threshold] = np.nan
+    cmap_axis = ax.scatter(x, y, c=pval_resampled, cmap=pval_cmap, zorder=10, marker='.', vmin=0, vmax=pval_threshold)
+
+    if draw_colorbar:
+        colorbar(cmap_axis)
+
+    ax.axis('equal')
+    ax.set_xlabel(f"{coord1_label} coordinates (mm)", fontsize=12)
+    ax.set_ylabel(f"{coord2_label} coordinates (mm)", fontsize=12)
+
+    ax.set_title(title, fontsize=20)
+    fig.tight_layout()
+
+    return fig, ax
@@ -1,99 +1,193 @@
+import json
+import logging
+import os
+import tempfile
 import numpy as np
 
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from numpy.lib.stride_tricks import sliding_window_view
 from warnings import warn
 
-from scipy import ndimage
+from dpr.cache import ShiftsCache
+from dpr.condensed import CondensedShifts
+from dpr.streamlines import Streamlines
+
+logger = logging.getLogger(__name__)
 
 
 def align_bundles(bundles, percent=15, padding=0., order=1, eps=1e-5, mode='full_template',
                   remove_outliers=True, remove_baseline=True, whiten=True, normalize=False,
-                  return_shifts_matrix=False, rematch_outliers=True):
-
-    bundles = np.array(bundles, copy=True)
+                  return_shifts_matrix=False, rematch_outliers=True, block_size=4096, fft_length='pow2',
+                  max_lag=None, backend='auto', levels=1, refine_radius=2, truncation=None, num_points=None,
+                  condensed=False, shifts_dtype=np.float64, subsample=None, stratify=False, seed=None, validation=0,
+                  cache_dir=None, n_jobs=1, reference=None, out=None):
+    '''
+    Realigns the bundles to the template with the most bundles within the overlap threshold.
+
+    bundles can also be a 3D stack of metrics of shape (metrics, bundles, points) for the same bundles, which are all
+    realigned with the same shifts. The shifts are estimated from bundles[reference] or, if reference is None,
+    from the sum of the cross power spectra of all the metrics, which only works with the fft backend.
+
+    bundles can also be memory mapped, e.g. with np.load(fname, mmap_mode='r'), in which case the padded copy of the
+    bundles and their spectra are also memory mapped to temporary files. As the bundles and the pairs are only processed
+    a block at a time, the peak memory is then about 100 * block_size * fft_length bytes for correlating the pairs,
+    plus the shifts matrix, which is the only array growing with the square of the number of bundles. It takes
+    8 * len(bundles)**2 bytes, or half as much with condensed=True and half again with shifts_dtype=np.float32,
+    while subsample only keeps the shifts to the subsampled bundles. With cache_dir, the pairwise shifts are also
+    a condensed float64 array, in memory while they are computed and memory mapped from the cache afterwards.
+    This does not hold for backend='direct' or levels > 1, which preprocess or downsample all the bundles
+    in memory at once.
+
+    out - array or path of a .npy file to write the realigned bundles into, which is then memory mapped
+    '''
 
     # if we zero padded, put them to nan for now
-    bundles[bundles == padding] = np.nan
+    bundles = _pad_bundles(bundles, padding, block_size=block_size)
+
+    # we only compare to a few bundles to pick the template, so there is no full shifts matrix
+    if subsample is not None and return_shifts_matrix:
+        raise ValueError('subsample only works in full_template mode and without return_shifts_matrix')
+
+    shifts, template_shifts, template = _estimate_shifts(bundles, percent=percent, eps=eps, mode=mode,
+                                                         remove_outliers=remove_outliers, remove_baseline=remove_baseline,
+                                                         whiten=whiten, normalize=normalize,
+                                                         rematch_outliers=rematch_outliers, block_size=block_size,
+                                                         fft_length=fft_length, max_lag=max_lag, backend=backend,
+                                                         levels=levels, refine_radius=refine_radius, condensed=condensed,
+                                                         shifts_dtype=shifts_dtype, subsample=subsample,
+                                                         stratify=stratify, seed=seed, validation=validation,
+                                                         cache_dir=cache_dir, n_jobs=n_jobs, reference=reference)
+
+    # use the custom shift patterns
+    ys = _apply_shifts(bundles, template_shifts, order=order, truncation=truncation, num_points=num_points, out=out)
+
+    if return_shifts_matrix:
+        return ys, shifts, template
+    else:
+        return ys, template_shifts
+
+
+def _estimate_shifts(bundles, percent=15, eps=1e-5, mode='full_template', remove_outliers=True, remove_baseline=True,
+                     whiten=True, normalize=False, rematch_outliers=True, block_size=4096, fft_length='pow2',
+                     max_lag=None, backend='auto', levels=1, refine_radius=2, condensed=False, shifts_dtype=np.float64,
+                     subsample=None, stratify=False, seed=None, validation=0, cache_dir=None, n_jobs=1, reference=None):
+    '''
+    Shifts of align_bundles for bundles already padded with nans, without realigning them.
+
+    Returns the shifts matrix (None with subsample), the shifts of each bundle to the template and the template.
+    '''
+
+    # the shifts only come from the reference metric if there is one
+    if bundles.ndim == 3 and reference is not None:
+        metric = bundles[reference]
+    else:
+        metric = bundles
+
+    npairs = bundles.shape[-2]
+    size_overlaps = np.zeros(npairs, dtype=np.intp)
+
+    for start in range(0, npairs, block_size):
+        present = np.isfinite(bundles[..., start:start + block_size, :])
+
+        # a point of a stack is only there if it is there for all the metrics
+        if bundles.ndim == 3:
+            present = np.all(present, axis=0)
+
+        size_overlaps[start:start + block_size] = present.sum(axis=1)
 
-    npairs = len(bundles)
-    size_overlaps = np.isfinite(bundles).sum(axis=1)
     maxoverlaps = np.ceil(percent * size_overlaps / 100)
-    shifts = np.zeros((npairs, npairs))
 
-    pairs = filter_pairs(npairs, mode=mode)
-    ffts = get_ffts(bundles, whiten=whiten, remove_baseline=remove_baseline)
-    ffta = np.zeros_like(ffts[0])
-    fftb = np.zeros_like(ffts[0])
+    if condensed and mode != 'full_template':
+        raise ValueError(f'The condensed shifts matrix is only available in full_template mode, but mode was {mode}')
 
-    for (a, b) in pairs:
-        ffta[:] = ffts[a]
-        fftb[:] = ffts[b]
-        shifts[a, b] = get_shift_from_fft(ffta, fftb, normalize=normalize)
+    # everything that changes the shifts, but not block_size and n_jobs which only change the memory and time used
+    params = dict(remove_baseline=remove_baseline, whiten=whiten, normalize=normalize, fft_length=fft_length,
+                  max_lag=max_lag, backend=backend, levels=levels, refine_radius=refine_radius)
 
-    # if we used a predefined template, we can just exit now with it
-    if len(pairs) < bundles.shape[0]:
+    if cache_dir is None or isinstance(cache_dir, ShiftsCache):
+        cache = cache_dir
+    else:
+        cache = ShiftsCache(cache_dir)
 
-        template = mode
-        ys = apply_shift(bundles, shifts[template])
+    options = dict(block_size=block_size, cache=cache, n_jobs=n_jobs, **params)
 
-        if return_shifts_matrix:
-            return ys, shifts, template
-        else:
-            return ys, shifts[template]
+    # we only compare to a few bundles to pick the template, so there is no full shifts matrix
+    if subsample is not None:
+        if mode != 'full_template':
+            raise ValueError('subsample only works in full_template mode')
 
-    shifts[np.abs(shifts) < eps] = 0.  # force symmetry at ~zero shift
+        template_shifts, template = subsample_template(metric, maxoverlaps, subsample, stratify=stratify, seed=seed,
+                                                       validation=validation, eps=eps, rematch_outliers=rematch_outliers,
+                                                       remove_outliers=remove_outliers, **options)
+        return None, template_shifts, template
 
-    # this is how many bundles are inside the overlapping threshold for bundle i
-    sumstuff = np.sum(np.abs(shifts) < maxoverlaps, axis=1)
+    # the shift of (b, a) is the opposite of (a, b) and the diagonal is zero,
+    # so we only need to correlate the upper triangle in full_template mode
+    pairs_mode = 'half' if mode == 'full_template' else mode
+    predefined = isinstance(mode, np.integer) or isinstance(mode, int)
 
-    # if we have more than one template, we pick the one with the min maximum shift
-    # this does not seem to happen on real data, only on synthetic
-    original_templater = np.argwhere(sumstuff == np.max(sumstuff))
+    # the pairs are made and correlated a tile at a time, which is split between the threads
+    tile_size = block_size * _num_workers(n_jobs)
 
-    if len(original_templater) > 1:
-        # abs(shifts) will be a symmetric matrix)
-        largest_shifts = np.max(np.abs(shifts), axis=1)[original_templater]
-        original_templater = original_templater[largest_shifts.argmin()]
+    if cache is None:
+        tiles = iter_pairwise_shifts(metric, iter_pairs(npairs, pairs_mode, block_size=tile_size), **options)
+    else:
+        def compute():
+            pairwise = np.zeros(_num_pairs(npairs, pairs_mode))
+            position = 0
 
-    original_templater = int(original_templater)  # it has a weird shape now if singleton
+            for _, _, values in iter_pairwise_shifts(metric, iter_pairs(npairs, pairs_mode, block_size=tile_size),
+                                                     **options):
+                pairwise[position:position + len(values)] = values
+                position += len(values)
 
-    if rematch_outliers:
-        condition = True
-        current_outliers = [None]
+            return pairwise
+
+        pairwise = cache.get_or_compute('shifts', compute, metric, pairs=pairs_mode, **params)
+        tiles = _split_tiles(pairwise, iter_pairs(npairs, pairs_mode, block_size=tile_size))
 
-        # while loop ends when outliers will be empty
-        while condition:
+    if condensed:
+        shifts = CondensedShifts(npairs, dtype=shifts_dtype)
+    else:
+        shifts = np.zeros((npairs, npairs), dtype=shifts_dtype)
+
+    position = 0
+
+    for rows, cols, values in tiles:
+        values = values.astype(shifts_dtype)
 
-            # this is the indices of the outliers for the best alignment template bundle we just found
-            outliers = np.abs(shifts[original_templater]) > maxoverlaps
-            outliers = np.arange(npairs)[outliers]
+        if not predefined:
+            values[np.abs(values) < eps] = 0.  # force symmetry at ~zero shift
 
-            candidates = np.abs(shifts[original_templater]) <= maxoverlaps
-            candidates = np.arange(npairs)[candidates]
+        # the pairs of the half mode are already in the order of the condensed upper triangle
+        if condensed:
+            shifts.data[position:position + len(values)] = values
+            position += len(values)
+        else:
+            shifts[rows, cols] = values
 
-            for outlier in outliers:
+            if mode == 'full_template':
+                shifts[cols, rows] = -values
 
-                # find the match that minimize distance to original template without having very large displacement
-                new_shifts = shifts[original_templater, :] + shifts[:, outlier]
+    # if we used a predefined template, we can just exit now with it
+    if predefined:
+        return shifts, shifts[mode], mode
 
-                # remove candidate templates which are also outliers themselves
-                indexes = [idx for idx in np.abs(new_shifts).argsort() if idx in candidates]
+    # this is how many bundles are inside the overlapping threshold for bundle i
+    if condensed:
+        sumstuff = shifts.count_within(maxoverlaps)
+    else:
+        sumstuff = np.zeros(npairs, dtype=np.intp)
+        step = max(1, 2**20 // max(npairs, 1))
 
-                if np.any(indexes):
-                    new_shifter = indexes[0]
-                    # this is the shift required to realign bundle -> new_template -> original template
-                    shifts[outlier, original_templater] = shifts[outlier, new_shifter] + shifts[new_shifter, original_templater]
-                    shifts[original_templater, outlier] = shifts[original_templater, new_shifter] + shifts[new_shifter, outlier]
+        for start in range(0, npairs, step):
+            sumstuff[start:start + step] = np.sum(np.abs(shifts[start:start + step]) < maxoverlaps, axis=1)
 
-            # We have some outliers which do not overlap between the threshold
-            # with the others, so we must break out of an infinite loop.
-            # We use a set since order is not important and we replace them outside the loop.
-            if set(current_outliers) == set(outliers):
-                rematch_outliers = False
-                break
+    original_templater = _pick_template(shifts, sumstuff)
 
-            current_outliers = outliers
-            condition = len(outliers)
+    if rematch_outliers:
+        relay_outliers(shifts, original_templater, maxoverlaps)
     else:
         # no rematch outliers? put them to zero/nan then
         outliers = np.abs(shifts[original_templater]) > maxoverlaps
@@ -108,16 +202,486 @@ def align_bundles(bundles, percent=15, padding=0., order=1, eps=1e-5, mode='full
 
         warn(f'Possible outliers found {outliers}')
 
-    # use the custom shift patterns
-    ys = apply_shift(bundles, shifts[original_templater])
+    return shifts, shifts[original_templater], original_templater
 
-    if return_shifts_matrix:
-        return ys, shifts, original_templater
+
+class DPR:
+    '''
+    Estimator style version of align_bundles, which keeps the shifts found by fit so that transform can realign
+    other metrics of the same bundles, or the same bundles with another number of points, without any correlation.
+
+    truncation, num_points, order - how transform truncates, resamples and interpolates the realigned bundles
+    padding - value used to pad the bundles, as in align_bundles
+    kwargs - the other options of align_bundles, used by fit to find the shifts
+    '''
+
+    def __init__(self, truncation='shortest', num_points=None, order=1, padding=0., **kwargs):
+        self.truncation = truncation
+        self.num_points = num_points
+        self.order = order
+        self.padding = padding
+        self.options = kwargs
+
+        self.shifts_matrix_ = None
+        self.shifts_ = None
+        self.template_ = None
+
+    def _pad(self, bundles):
+        block_size = self.options.get('block_size', 4096)
+
+        if isinstance(bundles, np.memmap):
+            return _pad_bundles(bundles, self.padding, block_size=block_size)
+
+        return _pad_bundles(np.asarray(bundles, dtype=np.float64), self.padding, block_size=block_size)
+
+    def fit(self, bundles):
+        self.shifts_matrix_, self.shifts_, self.template_ = _estimate_shifts(self._pad(bundles), **self.options)
+        return self
+
+    def _check_fitted(self):
+        if self.shifts_ is None:
+            raise ValueError('The model needs to be fitted or loaded first')
+
+    def transform(self, bundles, out=None):
+        '''
+        out - array or path of a .npy file to write the realigned bundles into, as in align_bundles
+        '''
+
+        self._check_fitted()
+        bundles = self._pad(bundles)
+
+        if bundles.shape[-2] != len(self.shifts_):
+            error = f'The model was fitted on {len(self.shifts_)} bundles, but there are {bundles.shape[-2]}'
+            raise ValueError(error)
+
+        return _apply_shifts(bundles, self.shifts_, order=self.order, truncation=self.truncation,
+                             num_points=self.num_points, out=out)
+
+    def fit_transform(self, bundles):
+        return self.fit(bundles).transform(bundles)
+
+    def save(self, fname):
+        '''
+        Saves the shifts to the template and the options of transform, but not the shifts matrix.
+        '''
+        self._check_fitted()
+        options = json.dumps(dict(truncation=self.truncation, num_points=self.num_points, order=self.order,
+                                  padding=self.padding))
+
+        # a file object prevents numpy from adding .npz to the name
+        with open(fname, 'wb') as file:
+            np.savez_compressed(file, shifts=self.shifts_, template=self.template_, options=options)
+
+    @classmethod
+    def load(cls, fname):
+
+        with np.load(fname) as data:
+            model = cls(**json.loads(data['options'].item()))
+            model.shifts_ = data['shifts']
+            model.template_ = data['template'].item()
+
+        return model
+
+
+def _pad_bundles(bundles, padding, block_size=4096):
+    '''
+    Copy of the bundles with nans instead of padding, which is memory mapped if the bundles are.
+    '''
+
+    if not isinstance(bundles, np.memmap):
+        bundles = np.array(bundles, copy=True)
+        bundles[bundles == padding] = np.nan
+        return bundles
+
+    padded = _empty_like(bundles, bundles.shape, bundles.dtype)
+    source = bundles.reshape(-1, bundles.shape[-1])
+    destination = padded.reshape(-1, bundles.shape[-1])
+
+    for start in range(0, len(source), block_size):
+        block = np.array(source[start:start + block_size])
+        block[block == padding] = np.nan
+        destination[start:start + block_size] = block
+
+    return padded
+
+
+def _empty_like(bundles, shape, dtype):
+    '''
+    New array for the intermediate results of these bundles. If they are memory mapped, it is also memory mapped
+    to an anonymous temporary file, which is removed once the array is not used anymore.
+    '''
+
+    if isinstance(bundles, np.memmap) and np.prod(shape) > 0:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+
+    return np.empty(shape, dtype=dtype)
+
+
+def _output_array(out, shape, dtype):
+    '''
+    Array where the realigned bundles are written, a new one if out is None, out itself if it is an array
+    or a new memory mapped .npy file if it is a path. out can also be a function returning the array from shape and dtype.
+    '''
+
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+
+    if isinstance(out, (str, os.PathLike)):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+    if callable(out):
+        return out(shape, dtype)
+
+    if out.shape != tuple(shape):
+        raise ValueError(f'out should be of shape {tuple(shape)}, but is {out.shape}')
+
+    return out
+
+
+def _pick_template(shifts, sumstuff):
+
+    # if we have more than one template, we pick the one with the min maximum shift
+    # this does not seem to happen on real data, only on synthetic
+    templaters = np.flatnonzero(sumstuff == np.max(sumstuff))
+
+    if len(templaters) > 1:
+        # abs(shifts) will be a symmetric matrix)
+        largest_shifts = [np.max(np.abs(shifts[templater])) for templater in templaters]
+        return int(templaters[np.argmin(largest_shifts)])
+
+    return int(templaters[0])
+
+
+def subsample_template(bundles, maxoverlaps, subsample, stratify=False, seed=None, validation=0, eps=1e-5,
+                       rematch_outliers=True, remove_outliers=True, **kwargs):
+    '''
+    Approximate version of the template selection of align_bundles, which only needs len(bundles) * subsample
+    correlations instead of all the pairs. Each bundle is scored against a subsample of bundles, the best one is
+    the template and every bundle is then aligned to it. The outliers can only be rematched through the subsample.
+
+    bundles - 2D array of bundles, or 3D stack of metrics as in align_bundles, padded with nans
+    maxoverlaps - largest allowed shift for each bundle
+    subsample - number of bundles to score the templates against
+    stratify - if True, the subsample is drawn evenly across the lengths of the bundles instead of at random
+    seed - seed of the random generator for the subsample and the validation, for reproducible results
+    validation - if more than 0, also pick the exact template of this many random bundles
+        and log how it compares to the approximate template on them
+    kwargs - options passed to get_pairwise_shifts
+
+    Returns the shifts of each bundle to the template and the index of the template.
+    '''
+
+    rng = np.random.default_rng(seed)
+    npairs = bundles.shape[-2]
+    subsample = min(int(subsample), npairs)
+
+    if stratify:
+        # one bundle at random in each of the strata of similar lengths, the shortest of the metrics for a stack
+        lengths = np.isfinite(bundles).sum(axis=-1).reshape(-1, npairs).min(axis=0)
+        order = np.argsort(lengths, kind='stable')
+        strata = np.array_split(order, subsample)
+        chosen = np.sort([rng.choice(stratum) for stratum in strata])
+    else:
+        chosen = np.sort(rng.choice(npairs, size=subsample, replace=False))
+
+    # shifts[i, m] is between bundle i and bundle chosen[m]
+    rows, cols = np.repeat(np.arange(npairs), subsample), np.tile(chosen, npairs)
+    shifts = get_pairwise_shifts(bundles, rows, cols, **kwargs).reshape(npairs, subsample)
+    shifts[np.abs(shifts) < eps] = 0.
+
+    sumstuff = np.sum(np.abs(shifts) < maxoverlaps[chosen], axis=1)
+    template = _pick_template(shifts, sumstuff)
+
+    template_shifts = get_pairwise_shifts(bundles, np.full(npairs, template), np.arange(npairs), **kwargs)
+    template_shifts[np.abs(template_shifts) < eps] = 0.
+
+    outliers = np.flatnonzero(np.abs(template_shifts) > maxoverlaps)
+
+    if rematch_outliers:
+        # the relays are the bundles of the subsample which are not outliers themselves
+        relays = np.flatnonzero(np.abs(template_shifts[chosen]) <= maxoverlaps[chosen])
+
+        if len(outliers) > 0 and len(relays) > 0:
+            # this is the shift required to realign bundle -> relay -> template
+            chained = template_shifts[chosen[relays]][:, None] - shifts[np.ix_(outliers, relays)].T
+            distance = np.abs(chained)
+            distance[np.isnan(distance)] = np.inf
+            template_shifts[outliers] = chained[distance.argmin(axis=0), np.arange(len(outliers))]
     else:
-        return ys, shifts[original_templater]
+        template_shifts[outliers] = np.nan if remove_outliers else 0.
+        warn(f'Possible outliers found {outliers}')
+
+    if validation > 0:
+        _validate_template(bundles, maxoverlaps, template, validation, rng, eps=eps, **kwargs)
+
+    return template_shifts, template
+
+
+def _validate_template(bundles, maxoverlaps, template, validation, rng, eps=1e-5, **kwargs):
+
+    # the approximate template is always part of the validation bundles
+    others = np.delete(np.arange(bundles.shape[-2]), template)
+    chosen = np.sort(np.append(rng.choice(others, size=min(validation, len(others)), replace=False), template))
+
+    rows, cols = np.triu_indices(len(chosen), 1)
+    shifts = np.zeros((len(chosen), len(chosen)))
+    shifts[rows, cols] = get_pairwise_shifts(bundles[..., chosen, :], rows, cols, **kwargs)
+    shifts[cols, rows] = -shifts[rows, cols]
+    shifts[np.abs(shifts) < eps] = 0.
+
+    sumstuff = np.sum(np.abs(shifts) < maxoverlaps[chosen], axis=1)
+    exact = _pick_template(shifts, sumstuff)
+    approximate = int(np.flatnonzero(chosen == template)[0])
+
+    logger.info(f'On {len(chosen)} validation bundles, the approximate template {template} has {sumstuff[approximate]} '
+                f'bundles within the overlap threshold and the exact template {chosen[exact]} has {sumstuff[exact]}')
+
+    return chosen[exact], sumstuff[approximate], sumstuff[exact]
+
+
+def relay_outliers(shifts, template, maxoverlaps, max_iter=100, block_size=1024):
+    '''
+    Realigns the outliers of the template through another bundle (a relay), in place.
+
+    The outliers are the bundles with a shift larger than maxoverlaps from the template, and the relays
+    are picked among the others. For each outlier, the relay is the one which makes the chained shift
+    outlier -> relay -> template the smallest. Outliers which end up close enough to the template
+    can be used as relays at the next iteration, until no outlier is left or none of them changed.
+
+    shifts - 2D matrix of pairwise shifts, modified in place
+    template - index of the template bundle
+    maxoverlaps - largest allowed shift for each bundle
+    max_iter - maximum number of iterations, which is also the longest chain of relays
+    block_size - number of outliers matched at once, which caps the memory used
+    '''
+
+    npairs = len(maxoverlaps)
+    current_outliers = None
+
+    for _ in range(max_iter):
+        # this is the indices of the outliers for the template
+        outliers = np.abs(shifts[template]) > maxoverlaps
+        outliers = np.arange(npairs)[outliers]
+
+        candidates = np.abs(shifts[template]) <= maxoverlaps
+        candidates = np.arange(npairs)[candidates]
+
+        # We have some outliers which do not overlap between the threshold
+        # with the others, so we stop once they stay the same.
+        if len(outliers) == 0 or np.array_equal(outliers, current_outliers):
+            break
+
+        # only the shifts of the outliers are modified, so they can all be matched at once
+        for start in range(0, len(outliers), block_size):
+            outlier = outliers[start:start + block_size]
+
+            # find the match that minimize distance to original template without having very large displacement
+            new_shifts = shifts[template, candidates][:, None] + shifts[np.ix_(candidates, outlier)]
+            new_shifts = np.abs(new_shifts)
+            new_shifts[np.isnan(new_shifts)] = np.inf
+            relay = candidates[new_shifts.argmin(axis=0)]
+
+            # this is the shift required to realign bundle -> relay -> template
+            shifts[outlier, template] = shifts[outlier, relay] + shifts[relay, template]
+            shifts[template, outlier] = shifts[template, relay] + shifts[relay, outlier]
+
+        current_outliers = outliers
+
+    return shifts
+
+
+def _apply_shifts(bundles, shifts, order=1, truncation=None, num_points=None, out=None):
+
+    # all the metrics of a stack go through a single pass with the same shifts, so they are truncated the same way
+    if bundles.ndim == 3:
+        nmetrics, nbundles, _ = bundles.shape
+
+        # the output keeps its 3D shape, but is filled as a 2D view
+        if isinstance(out, (str, os.PathLike)):
+            fname = out
+            out = lambda shape, dtype: _output_array(fname, (nmetrics, nbundles, shape[1]), dtype).reshape(shape)
+        elif out is not None:
+            flat = out.reshape(nmetrics * nbundles, -1)
+
+            if not np.shares_memory(flat, out):
+                raise ValueError('out must be contiguous, so that it can be filled as a 2D array')
+
+            out = flat
+
+        ys = _apply_shifts(bundles.reshape(nmetrics * nbundles, -1), np.tile(shifts, nmetrics), order=order,
+                           truncation=truncation, num_points=num_points, out=out)
+        return ys.reshape(nmetrics, nbundles, -1)
+
+    # the shifted rows are three times as long, so long bundles are done a few at a time to bound the temporaries
+    block_size = max(1, min(256, 2**16 // max(bundles.shape[1], 1)))
+
+    # without truncation, we return the whole shifted bundles three times as long
+    if truncation is None:
+        return apply_shift(bundles, shifts, order=order, block_size=block_size, out=out)
+
+    return shift_truncate_resample(bundles, shifts, mode=truncation, num_points=num_points, order=order,
+                                   block_size=block_size, out=out)
+
+
+def get_pairwise_shifts(bundles, rows, cols, remove_baseline=True, whiten=True, normalize=False, block_size=4096,
+                        fft_length='pow2', max_lag=None, backend='auto', levels=1, refine_radius=2, cache=None, n_jobs=1):
+    '''
+    Shifts between the pairs of bundles (rows[i], cols[i]), with the same options as align_bundles.
+
+    levels - number of levels of the coarse to fine pyramid. With more than one level, the shifts are first
+        estimated on bundles averaged over blocks of 2**(levels - 1) points, then refined at each finer level
+        by only looking at the lags within refine_radius of the previous estimate.
+    refine_radius - number of points around the previous estimate to look at for each finer level
+    cache - ShiftsCache to load the spectra from or store them in
+    n_jobs - number of threads correlating the pairs, -1 uses all the cores
+
+    bundles can also be a 3D stack of metrics, in which case the cross power spectra of the metrics are summed.
+    '''
+
+    tiles = iter_pairwise_shifts(bundles, [(rows, cols)], remove_baseline=remove_baseline, whiten=whiten,
+                                 normalize=normalize, block_size=block_size, fft_length=fft_length, max_lag=max_lag,
+                                 backend=backend, levels=levels, refine_radius=refine_radius, cache=cache, n_jobs=n_jobs)
+
+    return [shifts for _, _, shifts in tiles][0]
+
+
+def iter_pairwise_shifts(bundles, tiles, remove_baseline=True, whiten=True, normalize=False, block_size=4096,
+                         fft_length='pow2', max_lag=None, backend='auto', levels=1, refine_radius=2, cache=None,
+                         n_jobs=1):
+    '''
+    Same as get_pairwise_shifts, but for the tiles of pairs (rows, cols) given by iter_pairs, which are correlated
+    one after the other so that only the pairs and shifts of a tile are in memory. The spectra or signals
+    of the bundles are computed right away, once for all the tiles.
+
+    Yields rows, cols and the shifts of each tile.
+    '''
+
+    if bundles.ndim == 3 and (levels > 1 or backend == 'direct'):
+        raise ValueError('A stack of metrics only works with the fft backend and a single level')
+
+    options = dict(remove_baseline=remove_baseline, whiten=whiten, block_size=block_size, fft_length=fft_length,
+                   cache=cache, n_jobs=n_jobs)
+
+    if levels == 1:
+        correlate = _pair_correlator(bundles, normalize=normalize, max_lag=max_lag, backend=backend, **options)
+
+        def shifts_of_tiles():
+            for rows, cols in tiles:
+                yield rows, cols, correlate(rows, cols)
+
+        return shifts_of_tiles()
+
+    if normalize:
+        raise ValueError('The coarse to fine pyramid does not support normalize')
+
+    factor = 2**(levels - 1)
+
+    if np.ceil(bundles.shape[-1] / factor) < 2:
+        error = f'levels={levels} averages blocks of {factor} points, but the bundles only have {bundles.shape[-1]} points'
+        raise ValueError(error)
+
+    coarse_lag = None if max_lag is None else int(np.ceil(max_lag / factor))
+    coarse = _pair_correlator(downsample_bundles(bundles, factor), max_lag=coarse_lag, backend=backend, **options)
+
+    # the signals of each finer level, which are only correlated around the estimate of the previous one
+    finer = [(level, 2**level, preprocess_bundles(downsample_bundles(bundles, 2**level), whiten=whiten,
+                                                  remove_baseline=remove_baseline)) for level in range(levels - 2, -1, -1)]
+
+    def shifts_of_tiles():
+        # the sum, number and largest of the changes of each level, to log them once all the tiles are done
+        changes = {level: [0., 0, 0.] for level, _, _ in finer}
+
+        for rows, cols in tiles:
+            shifts = coarse(rows, cols) * factor
+
+            for level, level_factor, signals in finer:
+                refined = get_shifts_from_signals(signals, rows, cols, max_lag=refine_radius,
+                                                  centers=shifts / level_factor, block_size=block_size,
+                                                  n_jobs=n_jobs) * level_factor
+
+                change = np.abs(refined - shifts)
+                change = change[np.isfinite(change)]
+                changes[level][0] += np.sum(change)
+                changes[level][1] += len(change)
+                changes[level][2] = max(changes[level][2], np.max(change, initial=0))
+                shifts = refined
+
+            yield rows, cols, shifts
+
+        for level, (total, count, largest) in changes.items():
+            logger.info(f'Pyramid level {level} changed the shifts by {total / max(count, 1):.3f} points on average '
+                        f'and {largest:.3f} at most')
+
+    return shifts_of_tiles()
+
+
+def _pair_correlator(bundles, remove_baseline=True, whiten=True, normalize=False, block_size=4096, fft_length='pow2',
+                     max_lag=None, backend='auto', cache=None, n_jobs=1):
+    '''
+    Function giving the shifts of the pairs (rows, cols) at a single level, with the spectra or signals
+    of the bundles only computed once.
+    '''
+
+    n = get_fft_length(bundles.shape[-1], fft_length=fft_length)
+
+    if backend == 'auto' and bundles.ndim == 3:
+        backend = 'fft'
+    elif backend == 'auto':
+        backend = choose_backend(bundles.shape[1], n, max_lag=max_lag, normalize=normalize)
+
+    if backend == 'fft':
+        if cache is None:
+            ffts = get_ffts(bundles, whiten=whiten, remove_baseline=remove_baseline, fft_length=n, block_size=block_size)
+        else:
+            compute = partial(get_ffts, bundles, whiten=whiten, remove_baseline=remove_baseline, fft_length=n,
+                              block_size=block_size)
+            ffts = cache.get_or_compute('spectra', compute, bundles, whiten=whiten, remove_baseline=remove_baseline,
+                                        fft_length=n)
+
+        return partial(get_shifts_from_ffts, ffts, normalize=normalize, block_size=block_size, n=n, n_jobs=n_jobs)
+
+    if backend == 'direct':
+        if max_lag is None or normalize:
+            raise ValueError('The direct backend needs a max_lag and does not support normalize')
+
+        signals = preprocess_bundles(bundles, whiten=whiten, remove_baseline=remove_baseline)
+        return partial(get_shifts_from_signals, signals, max_lag=max_lag, block_size=block_size, n_jobs=n_jobs)
+
+    raise ValueError(f'Unrecognized backend {backend}')
+
+
+def downsample_bundles(bundles, factor):
+    '''
+    Averages each bundle over blocks of factor points, ignoring the nans.
+    Blocks without any finite value are set to nan.
+    '''
+
+    if factor == 1:
+        return bundles
+
+    length = int(np.ceil(bundles.shape[1] / factor)) * factor
+    padded = np.full((bundles.shape[0], length), np.nan)
+    padded[:, :bundles.shape[1]] = bundles
+    blocks = padded.reshape(bundles.shape[0], -1, factor)
 
+    finite = np.isfinite(blocks)
+    count = finite.sum(axis=2)
+    total = np.where(finite, blocks, 0).sum(axis=2)
 
-def resample_bundles_to_same(bundles, num_points=None):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        downsampled = total / count
+
+    return downsampled
+
+
+def resample_bundles_to_same(bundles, num_points=None, dtype=np.float64, out=None):
+    '''
+    Linearly resamples each bundle to num_points, as np.interp would.
+    A point next to a nan is also nan, unless it falls exactly on an original point.
+
+    dtype - type of the output array
+    out - if given, the results are written in this array of shape (len(bundles), num_points) instead
+    '''
 
     if bundles.ndim == 1:
         bundles = bundles[None, :]
@@ -129,71 +693,182 @@ def resample_bundles_to_same(bundles, num_points=None):
     if num_points is None:
         num_points = bundles.shape[1]
 
-    resampled = np.zeros((bundles.shape[0], num_points))
+    if out is None:
+        out = np.zeros((bundles.shape[0], num_points), dtype=dtype)
 
-    for i in range(len(bundles)):
-        strip = bundles[i]
-        length = len(strip)
-        old_coord = np.linspace(1, length + 1, num=length, endpoint=True) / length
-        new_coord = np.linspace(1, length + 1, num=num_points, endpoint=True) / length
-        interp = np.interp(new_coord, old_coord, strip)
-        resampled[i] = interp
+    length = bundles.shape[1]
+    old_coord = np.linspace(1, length + 1, num=length, endpoint=True) / length
+    new_coord = np.linspace(1, length + 1, num=num_points, endpoint=True) / length
 
-    return resampled
+    if length == 1:
+        out[:] = bundles
+        return out
+
+    # the coordinates are the same for every bundle, so we find where to interpolate only once
+    index = np.clip(np.searchsorted(old_coord, new_coord, side='right') - 1, 0, length - 2)
+    exact = new_coord == old_coord[index]
+    last = new_coord >= old_coord[-1]
+
+    left = bundles[:, index].astype(np.float64)
+    right = bundles[:, index + 1].astype(np.float64)
 
+    # same operations as np.interp so we get the same values
+    slope = (right - left) / (old_coord[index + 1] - old_coord[index])
+    interp = slope * (new_coord - old_coord[index]) + left
+    interp[:, exact] = left[:, exact]
+    interp[:, last] = bundles[:, -1:]
 
-def apply_shift(bundles, shifts, order=1, padding=np.nan):
+    out[:] = interp
+    return out
 
-    shifted_bundles = np.zeros((bundles.shape[0], 3 * bundles.shape[1]), dtype=np.float32)
 
-    for idx in range(bundles.shape[0]):
-        bundle = bundles[idx]
-        shift = shifts[idx]
+def apply_shift(bundles, shifts, order=1, padding=np.nan, fourier=False, block_size=256, out=None):
+    '''
+    Moves each bundle by its shift inside a row three times as long, which is filled with padding.
+    A shift of nan is an outlier, so the bundle is not moved.
+
+    order - 0 (nearest) and 1 (linear) are interpolated for all the bundles at once,
+        higher orders use the splines of scipy.ndimage.shift one bundle at a time
+    fourier - if True, the shifts are done with a phase shift in the Fourier domain instead
+    block_size - number of bundles shifted at once, which caps the memory used for the indexes
+    out - float32 array or path of a .npy file to write the shifted bundles into, which is then memory mapped
+    '''
 
-        # if a shift is nan, it's an outlier anyway
-        if np.isnan(shift):
-            shift = 0
+    shifts = np.asarray(shifts, dtype=np.float64)
+    shifts = np.where(np.isnan(shifts), 0, shifts)
 
-        invoxel_shift, integer_shift = np.modf(shift)
-        integer_shift = int(integer_shift)
-        pad = np.full(len(bundle), padding)
+    shifted_bundles = _output_array(out, (bundles.shape[0], 3 * bundles.shape[1]), np.float32)
+    columns = np.arange(shifted_bundles.shape[1])
 
-        new = np.concatenate((pad, bundle, pad))
-        new = np.roll(new, integer_shift)
-        new = ndimage.shift(new, invoxel_shift, order=order, mode='constant', cval=padding)
+    for start in range(0, bundles.shape[0], block_size):
+        stop = start + block_size
 
-        shifted_bundles[idx] = new
+        if fourier:
+            shifted_bundles[start:stop] = _fourier_shift_rows(bundles[start:stop], shifts[start:stop], padding=padding)
+        elif order <= 1:
+            shifted_bundles[start:stop] = _shift_rows(bundles[start:stop], shifts[start:stop], columns,
+                                                      order=order, padding=padding)
+        else:
+            for idx in range(start, min(stop, bundles.shape[0])):
+                shifted_bundles[idx] = _spline_shift_row(bundles[idx], shifts[idx], order=order, padding=padding)
 
     return shifted_bundles
 
 
+def _spline_shift_row(bundle, shift, order=1, padding=np.nan):
+
+    # only imported here as it is slow to load and only needed for the splines
+    from scipy import ndimage
+
+    invoxel_shift, integer_shift = np.modf(shift)
+    integer_shift = int(integer_shift)
+    pad = np.full(len(bundle), padding)
+
+    new = np.concatenate((pad, bundle, pad))
+    new = np.roll(new, integer_shift)
+    new = ndimage.shift(new, invoxel_shift, order=order, mode='constant', cval=padding)
+
+    return new
+
+
+def _shift_rows(bundles, shifts, columns, order=1, padding=np.nan):
+    '''
+    Same as _spline_shift_row for order 0 or 1, but for all the rows at once and only at the given columns.
+    '''
+
+    length = bundles.shape[1]
+    width = 3 * length
+    invoxel_shift, integer_shift = np.modf(shifts)
+
+    rolled = np.full((bundles.shape[0], width), padding, dtype=np.float64)
+    rolled[:, length:2 * length] = bundles
+
+    # this is where ndimage.shift interpolates from in the rolled row, anything outside of it is padding
+    coords = columns[None, :] - invoxel_shift[:, None]
+    outside = (coords < 0) | (coords > width - 1)
+
+    if order == 0:
+        first = np.floor(coords + 0.5)
+    else:
+        first = np.floor(coords)
+        weights = coords - first
+
+    # index in the row before np.roll, which wraps around
+    first = first.astype(np.intp)
+    indexes = np.mod(first - integer_shift.astype(np.intp)[:, None], width)
+    shifted = np.take_along_axis(rolled, indexes, axis=1)
+
+    if order != 0:
+        # like ndimage, the second point is still used with a zero weight, so a nan neighbor gives a nan
+        indexes += first < width - 1
+        indexes[indexes == width] = 0
+        shifted *= 1 - weights
+        shifted += weights * np.take_along_axis(rolled, indexes, axis=1)
+
+    shifted[outside] = padding
+    return shifted
+
+
+def _fourier_shift_rows(bundles, shifts, padding=np.nan):
+    '''
+    Moves the rows of [padding, bundle, padding] with a phase shift, which wraps around like np.roll.
+    The points which were interpolated from the padding are set back to the padding afterwards.
+    '''
+
+    length = bundles.shape[1]
+    width = 3 * length
+    rows = np.zeros((bundles.shape[0], width))
+    rows[:, length:2 * length] = np.nan_to_num(np.where(bundles == padding, 0, bundles))
+
+    phase = np.exp(-2j * np.pi * np.fft.rfftfreq(width)[None, :] * shifts[:, None])
+    shifted = np.fft.irfft(np.fft.rfft(rows, axis=1) * phase, n=width, axis=1)
+
+    # a point is valid only if it is fully interpolated from valid points with the linear version
+    valid = np.isfinite(bundles) & (bundles != padding)
+    coverage = _shift_rows(valid.astype(np.float64), shifts, np.arange(width), order=1, padding=0.)
+    shifted[~(coverage > 1 - 1e-6)] = padding
+
+    return shifted
+
+
 def flip_fibers(bundles, coordinates, padding=np.nan, template=None):
     '''
     bundle - 2D array of M bundles with each metrics of size N as a column
-    coordinates - list of points of size whatever x 3
+    coordinates - dpr.streamlines.Streamlines or list of points of size whatever x 3
     template - Use this streamline to set the coordinate system.
         If not set, we use the first one from coordinates.
     '''
 
-    if coordinates[0].shape[1] != 3:
+    if not isinstance(coordinates, Streamlines):
+        coordinates = Streamlines.from_list(coordinates, dtype=np.asarray(coordinates[0]).dtype)
+
+    if coordinates.points.ndim != 2 or coordinates.points.shape[1] != 3:
         raise ValueError(f'coordinates should be Nx3 but is {coordinates[0].shape}')
 
-    new_bundles = np.zeros_like(bundles)
+    if len(coordinates) < bundles.shape[0]:
+        raise ValueError(f'There are {bundles.shape[0]} bundles, but coordinates for only {len(coordinates)} of them')
 
     if template is None:
         template = coordinates[0]
 
-    for idx in range(bundles.shape[0]):
-        A = np.sqrt(np.sum((template[0]  - coordinates[idx][0])**2)) + np.sqrt(np.sum((template[-1] - coordinates[idx][-1])**2))
-        B = np.sqrt(np.sum((template[-1] - coordinates[idx][0])**2)) + np.sqrt(np.sum((template[-1] - coordinates[idx][0])**2))
+    # only the ends of each streamline are compared, a streamline is reversed if its ends are closer to the opposite ends
+    first = coordinates.first[:bundles.shape[0]]
+    last = coordinates.last[:bundles.shape[0]]
 
-        if A > B:
-            new_bundles[idx] = np.nan_to_num(bundles[idx][::-1])
-            # we still want the padding at the right end though
-            cut = np.trim_zeros(new_bundles[idx], trim='f')
-            new_bundles[idx] = np.concatenate((cut, np.full(bundles.shape[1] - len(cut), padding)))
-        else:
-            new_bundles[idx] = bundles[idx]
+    A = np.linalg.norm(template[0] - first, axis=1) + np.linalg.norm(template[-1] - last, axis=1)
+    B = np.linalg.norm(template[-1] - first, axis=1) + np.linalg.norm(template[0] - last, axis=1)
+    flipped = np.flatnonzero(A > B)
+
+    new_bundles = np.array(bundles, copy=True)
+    rows = new_bundles[flipped]
+
+    # the points after the last valid one are padding, so only the valid part is reversed and the padding stays at the right end
+    valid = np.isfinite(rows) & (rows != 0)
+    length = np.where(valid.any(axis=1), rows.shape[1] - np.argmax(valid[:, ::-1], axis=1), 0)
+
+    indexes = length[:, None] - 1 - np.arange(rows.shape[1])
+    rows = np.take_along_axis(rows, np.maximum(indexes, 0), axis=1)
+    new_bundles[flipped] = np.where(indexes >= 0, rows, padding)
 
     return new_bundles
 
@@ -204,8 +879,22 @@ def truncate(bundles, mode='shortest', trimval=np.nan, axis=0):
         error = f'Number of dimension must be lower than 2, but was {bundles.ndim}'
         raise ValueError(error)
 
+    threshold = _truncation_threshold(bundles.shape[0], mode)
+
+    if np.isnan(trimval):
+        indexes = np.isfinite(bundles).sum(axis=axis) >= threshold
+    else:
+        indexes = np.sum(bundles != trimval, axis=axis) >= threshold
+
+    truncated = bundles[:, indexes].copy()
+
+    return truncated
+
+
+def _truncation_threshold(nbundles, mode):
+
     if mode == 'shortest':
-        threshold = bundles.shape[0]
+        threshold = nbundles
     elif mode == 'longest':
         threshold = 1
     elif isinstance(mode, int):
@@ -213,59 +902,191 @@ def truncate(bundles, mode='shortest', trimval=np.nan, axis=0):
         if mode > 100 or mode < 1:
             raise ValueError(f'mode must be between 1 and 100 {mode}')
 
-        threshold = np.floor(mode * bundles.shape[0] / 100)
+        threshold = np.floor(mode * nbundles / 100)
     else:
         raise ValueError(f'Unrecognized truncation mode {mode}')
 
-    if np.isnan(trimval):
-        indexes = np.isfinite(bundles).sum(axis=axis) >= threshold
-    else:
-        indexes = np.sum(bundles != trimval, axis=axis) >= threshold
+    return threshold
 
-    truncated = bundles[:, indexes].copy()
 
-    return truncated
+def shift_truncate_resample(bundles, shifts, mode='shortest', num_points=None, order=1, padding=np.nan, block_size=256,
+                            out=None):
+    '''
+    Same as resample_bundles_to_same(truncate(apply_shift(bundles, shifts), mode), num_points),
+    but the shifted bundles three times as long are only computed block_size at a time,
+    so the memory used stays close to the size of the output.
+
+    out - array or path of a .npy file to write the resampled bundles into, which is then memory mapped
+    '''
+
+    shifts = np.asarray(shifts, dtype=np.float64)
+    width = 3 * bundles.shape[1]
+    columns = np.arange(width)
+
+    def shifted_block(start, stop, columns):
+        if order <= 1:
+            block = _shift_rows(bundles[start:stop], np.where(np.isnan(shifts[start:stop]), 0, shifts[start:stop]),
+                                columns, order=order, padding=padding)
+            return block.astype(np.float32)
+
+        return apply_shift(bundles[start:stop], shifts[start:stop], order=order, padding=padding)[:, columns]
+
+    # first pass to find which columns truncate would keep
+    count = np.zeros(width, dtype=np.intp)
+
+    for start in range(0, bundles.shape[0], block_size):
+        block = shifted_block(start, start + block_size, columns)
+
+        if np.isnan(padding):
+            count += np.isfinite(block).sum(axis=0)
+        else:
+            count += np.sum(block != padding, axis=0)
+
+    columns = np.flatnonzero(count >= _truncation_threshold(bundles.shape[0], mode))
+
+    if num_points is None:
+        num_points = len(columns)
+
+    # second pass to only shift and resample the columns we keep
+    resampled = _output_array(out, (bundles.shape[0], num_points), np.float64)
+
+    for start in range(0, bundles.shape[0], block_size):
+        block = shifted_block(start, start + block_size, columns)
+        resample_bundles_to_same(block, num_points=num_points, out=resampled[start:start + block_size])
+
+    return resampled
 
 
 def filter_pairs(allpairs, mode):
+    '''
+    List of the pairs (i, j) to correlate, kept for compatibility as pair_indices or iter_pairs do not build the tuples.
+    '''
+    rows, cols = pair_indices(allpairs, mode)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def pair_indices(allpairs, mode, block_size=2**20):
+    '''
+    Indexes of the pairs (rows[k], cols[k]) to correlate, in the same order as filter_pairs.
+
+    allpairs - number of bundles or the indexes of the bundles to use
+    mode - 'full_template' or 'everything' for all the pairs, 'full' for all the pairs but the diagonal,
+        'half' for the pairs with j > i only, or an integer for the pairs (mode, j) of this template only
+    block_size - number of pairs built at once, see iter_pairs
+    '''
+    tiles = iter_pairs(allpairs, mode, block_size=block_size)
+
+    # the tiles are copied in place as they come, so the pairs are only in memory once
+    rows = np.zeros(_num_pairs(allpairs, mode), dtype=np.intp)
+    cols = np.zeros(len(rows), dtype=np.intp)
+    position = 0
+
+    for tile_rows, tile_cols in tiles:
+        rows[position:position + len(tile_rows)] = tile_rows
+        cols[position:position + len(tile_cols)] = tile_cols
+        position += len(tile_rows)
+
+    return rows, cols
+
+
+def _num_pairs(allpairs, mode):
+    '''
+    Number of pairs given by iter_pairs, without making them.
+    '''
+
+    if isinstance(allpairs, np.integer) or isinstance(allpairs, int):
+        allpairs = np.arange(allpairs)
+
+    values = np.asarray(allpairs, dtype=np.intp)
+
+    if isinstance(mode, np.integer) or isinstance(mode, int):
+        return int(np.count_nonzero(values != mode))
+
+    # the pairs of equal indexes are on the diagonal
+    _, counts = np.unique(values, return_counts=True)
+    everything = len(values)**2
+    diagonal = int(np.sum(counts**2))
+
+    if mode == 'half':
+        return (everything - diagonal) // 2
+    elif mode == 'full':
+        return everything - diagonal
+
+    return everything
+
+
+def _split_tiles(pairwise, tiles):
+    '''
+    Yields the tiles of pairs with their part of the shifts of all the pairs, in the same order.
+    '''
+    position = 0
+
+    for rows, cols in tiles:
+        yield rows, cols, pairwise[position:position + len(rows)]
+        position += len(rows)
+
+
+def iter_pairs(allpairs, mode, block_size=4096):
+    '''
+    Lazy version of pair_indices, which yields the arrays rows, cols of about block_size pairs at a time
+    so the full list of pairs is never in memory.
+    '''
 
     if isinstance(allpairs, np.integer) or isinstance(allpairs, int):
-        allpairs = list(range(allpairs))
+        allpairs = np.arange(allpairs)
+
+    values = np.asarray(allpairs, dtype=np.intp)
 
     if isinstance(mode, np.integer) or isinstance(mode, int):
-        return [x for x in product([mode], allpairs) if x[1] != mode]
-    elif mode == 'full_template':
-        pairs = []
-        for template in allpairs:
-            pairs += [x for x in product([template], allpairs)]
-        return pairs
+        func = None
+    elif mode == 'full_template' or mode == 'everything':
+        func = lambda j, i: np.ones(np.broadcast_shapes(j.shape, i.shape), dtype=bool)
     elif mode == 'half':
         func = np.greater
     elif mode == 'full':
         func = np.not_equal
-    elif mode == 'everything':
-        func = lambda *_: True  # this always return True
     else:
         error = f'String mismatch, mode was {mode} of type {type(mode)}'
         raise ValueError(error)
 
-    output = []
-    for i, j in product(allpairs, repeat=2):
-        if func(j, i):
-            output += [(i, j)]
+    # the checks above are done right away, so the error is not delayed until the first tile
+    def tiles():
+        if func is None:
+            others = values[values != mode]
+
+            for start in range(0, len(others), block_size):
+                cols = others[start:start + block_size]
+                yield np.full(len(cols), mode, dtype=np.intp), cols
+            return
 
-    return output
+        # a few rows at a time, so that each tile has about block_size pairs
+        step = max(1, block_size // max(len(values), 1))
 
+        for start in range(0, len(values), step):
+            template = values[start:start + step]
+            i, j = np.nonzero(func(values, template[:, None]))
+            yield template[i], values[j]
 
-def get_shift_from_fft(x, y, normalize=False):
+    return tiles()
 
-    spectrum = crosscorr(x, y, normalize=normalize)
+
+def get_shift_from_fft(x, y, normalize=False, n=None):
+
+    spectrum = crosscorr(x, y, normalize=normalize, n=n)
 
     peak = spectrum.argmax()
     max_value = spectrum[peak]
-    # this works because we pad up to 2**N, so it's always even.
+    # fftshift puts the zero lag at the center, which is also right for odd lengths
     half_length = len(spectrum) // 2
 
+    # e.g. a flat bundle, which has no shift
+    if not np.isfinite(max_value):
+        return np.nan
+
+    # a peak on the edge only has one neighbor, so we can not refine it
+    if peak == 0 or peak == len(spectrum) - 1:
+        return peak - half_length
+
     m0 = spectrum[peak - 1]
     m1 = spectrum[peak + 1]
     p0 = peak - 1
@@ -276,49 +1097,249 @@ def get_shift_from_fft(x, y, normalize=False):
     return shift
 
 
-def get_ffts(bundles, whiten=True, remove_baseline=True):
+def get_shifts_from_ffts(ffts, rows, cols, normalize=False, block_size=4096, n=None, n_jobs=1):
+    '''
+    ffts - 2D array of spectra as computed by get_ffts, one per bundle,
+        or a 3D stack of spectra for each metric, whose cross power spectra are summed
+    rows, cols - indexes of the pairs (a, b) to correlate, so that shifts[i] is for ffts[rows[i]] and ffts[cols[i]]
+    block_size - number of pairs correlated at once, which caps the peak memory usage
+    n - length of the transform used by get_ffts, needed if it was odd
+    n_jobs - number of threads correlating the blocks, -1 uses all the cores
+    '''
+
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+    shifts = np.zeros(len(rows))
+
+    # each block goes through a single irfft call instead of one per pair
+    def correlate(start, stop):
+        spectra = crosscorr(ffts[..., rows[start:stop], :], ffts[..., cols[start:stop], :], normalize=normalize, n=n)
+        shifts[start:stop] = parabolic_peaks(spectra) - spectra.shape[1] // 2
+
+    _map_blocks(correlate, len(rows), block_size=block_size, n_jobs=n_jobs)
+    return shifts
+
+
+def _num_workers(n_jobs):
+    '''
+    Number of threads used for n_jobs, where -1 or None uses all the cores.
+    '''
+    if n_jobs is None or n_jobs < 1:
+        return os.cpu_count() or 1
+
+    return n_jobs
+
+
+def _map_blocks(function, size, block_size=4096, n_jobs=1):
+    '''
+    Calls function(start, stop) on consecutive blocks covering range(size), in a pool of n_jobs threads if more than one.
+    The blocks are made smaller if needed to keep all the threads busy, so up to n_jobs blocks are in memory at once.
+    Each block writes its own part of the output, so the result is the same whatever the number of threads.
+    '''
+
+    n_jobs = _num_workers(n_jobs)
+
+    if n_jobs > 1:
+        block_size = max(1, min(block_size, -(-size // n_jobs)))
+
+    blocks = [(start, min(start + block_size, size)) for start in range(0, size, block_size)]
+
+    if n_jobs == 1 or len(blocks) < 2:
+        for start, stop in blocks:
+            function(start, stop)
+        return
+
+    # numpy releases the gil for the ffts and arithmetic, so threads are enough and nothing is copied
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for future in [pool.submit(function, start, stop) for start, stop in blocks]:
+            future.result()
+
+
+def get_fft_length(num_points, fft_length='pow2'):
+    '''
+    Length of the transform to compute the linear (not circular) cross-correlation of bundles with num_points
+
+    fft_length - 'pow2' pads to the next power of two,
+                 'fast' pads to the next 5-smooth length which is usually much shorter
+                 an int uses this length directly
+    '''
+
+    # anything shorter than this wraps around
+    N = 2 * num_points - 1
+
+    if fft_length == 'pow2':
+        return 2**int(np.ceil(np.log2(N)))
+    elif fft_length == 'fast':
+        from scipy.fft import next_fast_len
+        return next_fast_len(N, real=True)
+    elif isinstance(fft_length, np.integer) or isinstance(fft_length, int):
+        if fft_length < N:
+            error = f'fft_length must be at least {N} for bundles with {num_points} points, but was {fft_length}'
+            raise ValueError(error)
+        return int(fft_length)
+    else:
+        error = f'Unrecognized fft_length {fft_length}'
+        raise ValueError(error)
+
+
+def get_shifts_from_signals(signals, rows, cols, max_lag, block_size=4096, centers=None, n_jobs=1):
+    '''
+    Same as get_shifts_from_ffts, but only evaluates the lags between -max_lag and max_lag
+    with a direct dot product, which is faster than the fft when max_lag is small.
+
+    signals - 2D array of bundles as computed by preprocess_bundles, one per bundle
+    rows, cols - indexes of the pairs (a, b) to correlate, so that shifts[i] is for signals[rows[i]] and signals[cols[i]]
+    max_lag - largest shift (in points) to look for, pairs with a peak further than that are set to +- (max_lag + 1)
+    block_size - number of pairs correlated at once, which caps the peak memory usage
+    centers - if given, look at the lags within max_lag of (the rounded value of) centers[i] for each pair instead of around 0.
+        Pairs with a nan center, e.g. a flat coarse bundle, have no estimate to refine and stay nan.
+    n_jobs - number of threads correlating the blocks, -1 uses all the cores
+    '''
+
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+    shifts = np.zeros(len(rows))
+
+    if centers is None:
+        missing = np.zeros(len(rows), dtype=bool)
+        centers = np.zeros(len(rows), dtype=np.intp)
+    else:
+        centers = np.asarray(centers, dtype=np.float64)
+        missing = ~np.isfinite(centers)
+        centers = np.rint(np.where(missing, 0, centers)).astype(np.intp)
+
+    # one more lag on each side so the peak at +- max_lag can still be refined
+    band = int(max_lag) + 1
+    length = signals.shape[1]
+    offset = band + np.max(np.abs(centers), initial=0)
+    padded = np.zeros((signals.shape[0], length + 2 * offset))
+    padded[:, offset:offset + length] = signals
+    positions = np.arange(length)
+
+    def correlate(start, stop):
+        block = padded[rows[start:stop]]
+        center = centers[start:stop]
+
+        if np.all(center == 0):
+            # window k is signal a moved by k - band, so this is the same as the fft version for these lags only
+            windows = sliding_window_view(block[:, offset - band:offset + band + length], length, axis=1)
+            spectra = np.einsum('ijk,ik->ij', windows, signals[cols[start:stop]])
+        else:
+            # each pair has its own window, so we gather them one lag at a time
+            spectra = np.zeros((len(block), 2 * band + 1))
+            first = offset - band + center
+
+            for k in range(2 * band + 1):
+                moved = np.take_along_axis(block, (first + k)[:, None] + positions, axis=1)
+                spectra[:, k] = np.einsum('ij,ij->i', moved, signals[cols[start:stop]])
+
+        shifts[start:stop] = parabolic_peaks(spectra) - band + center
+
+    _map_blocks(correlate, len(rows), block_size=block_size, n_jobs=n_jobs)
+    shifts[missing] = np.nan
+    return shifts
+
+
+def choose_backend(num_points, n, max_lag=None, normalize=False):
+    '''
+    Picks the direct correlation if the window of lags is cheaper than a transform of length n,
+    or the fft otherwise. The constant comes from timing both on bundles of 100 to 1000 points.
+    '''
+
+    if max_lag is None or normalize:
+        return 'fft'
+
+    direct_cost = (2 * max_lag + 3) * num_points
+    fft_cost = 4 * n * np.log2(n)
+
+    if direct_cost <= fft_cost:
+        return 'direct'
+    return 'fft'
+
+
+def preprocess_bundles(bundles, whiten=True, remove_baseline=True):
+    '''
+    Removes the linear trend and whitens each bundle, then packs the finite values
+    to the left of each row with zeros afterwards, as used for the cross-correlation.
+    '''
 
-    bundles = np.copy(bundles)
+    bundles = np.asarray(bundles, dtype=np.float64)
     finite = np.isfinite(bundles)
+    count = finite.sum(axis=1, keepdims=True)
+    values = np.where(finite, bundles, 0.)
 
-    if remove_baseline:
-        for i in range(bundles.shape[0]):
-            bundle = bundles[i, finite[i]]
-            line = np.linspace(0., np.sqrt(bundle.max()), len(bundle))
-            lin_fit = np.polyfit(line, bundle, 1)
-            trend = np.polyval(lin_fit, line)
-            bundles[i, finite[i]] -= trend
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if remove_baseline:
+            # the finite values of each row are fitted against np.linspace(0, sqrt(max), count)
+            maximum = np.max(np.where(finite, bundles, -np.inf), axis=1, keepdims=True)
+            line = (np.cumsum(finite, axis=1) - 1) * (np.sqrt(maximum) / (count - 1))
+            line[~finite] = 0
 
-    if whiten:
-        for i in range(bundles.shape[0]):
-            mean = np.mean(bundles[i, finite[i]])
-            std = np.std(bundles[i, finite[i]])
-            bundles[i, finite[i]] = (bundles[i, finite[i]] - mean) / std
+            # closed form least squares line, same as np.polyfit(line, bundle, 1)
+            mean_line = line.sum(axis=1, keepdims=True) / count
+            mean_values = values.sum(axis=1, keepdims=True) / count
+            centered = np.where(finite, line - mean_line, 0.)
+            slope = np.sum(centered * values, axis=1, keepdims=True) / np.sum(centered**2, axis=1, keepdims=True)
 
-    N = 2 * bundles.shape[1] - 1
-    pad = 2**int(np.ceil(np.log2(N)))
-    ffts = np.zeros((bundles.shape[0], pad//2 + 1), dtype=np.complex128)
+            # a single point has no slope, so we only remove its mean
+            slope[~np.isfinite(slope)] = 0
+            values = np.where(finite, values - mean_values - slope * centered, 0.)
 
-    for i in range(bundles.shape[0]):
-        bundle = bundles[i, finite[i]]
-        ffts[i] = np.fft.rfft(bundle, n=pad)
+        if whiten:
+            mean = values.sum(axis=1, keepdims=True) / count
+            std = np.sqrt(np.sum(np.where(finite, values - mean, 0.)**2, axis=1, keepdims=True) / count)
+            values = np.where(finite, (values - mean) / std, 0.)
 
-    return ffts
+    # nothing to move if the finite values are already on the left, which is the usual case
+    left_aligned = np.arange(bundles.shape[1]) < count
 
+    if np.array_equal(finite, left_aligned):
+        return values
 
-def crosscorr(ffta, fftb, normalize=False):
+    order = np.argsort(~finite, axis=1, kind='stable')
+    signals = np.take_along_axis(values, order, axis=1)
+    signals[~left_aligned] = 0
+
+    return signals
+
+
+def get_ffts(bundles, whiten=True, remove_baseline=True, fft_length='pow2', block_size=1024):
+    '''
+    block_size - number of bundles transformed at once, which caps the memory used by the preprocessing.
+        The spectra are memory mapped to a temporary file if the bundles are memory mapped.
+    '''
+
+    # each bundle is processed on its own, so a stack of metrics is done in the same batch
+    flat = bundles.reshape(-1, bundles.shape[-1])
+    pad = get_fft_length(bundles.shape[-1], fft_length=fft_length)
+    ffts = _empty_like(bundles, (flat.shape[0], pad // 2 + 1), np.complex128)
+
+    for start in range(0, flat.shape[0], block_size):
+        signals = preprocess_bundles(flat[start:start + block_size], whiten=whiten, remove_baseline=remove_baseline)
+        ffts[start:start + block_size] = np.fft.rfft(signals, n=pad, axis=1)
+
+    return ffts.reshape(bundles.shape[:-1] + (-1,))
+
+
+def crosscorr(ffta, fftb, normalize=False, n=None):
 
     A = ffta
     B = fftb.conj()
+    cross = A * B
+
+    # a 3D stack of metrics for the same pairs is summed, so there is only one irfft per pair
+    if cross.ndim == 3:
+        cross = cross.sum(axis=0)
 
     if normalize:
-        norm = np.abs(A * B)
+        norm = np.abs(cross)
     else:
         norm = 1
 
-    result = np.fft.irfft(A * B / norm)
+    # this also works for a 2D stack of spectra, with one pair per row
+    result = np.fft.irfft(cross / norm, n=n, axis=-1)
 
-    return np.fft.fftshift(result)
+    return np.fft.fftshift(result, axes=-1)
 
 
 def extrapolate(x, y, return_value=False):
@@ -336,3 +1357,41 @@ def extrapolate(x, y, return_value=False):
     if return_value:
         return peak, value
     return peak
+
+
+def parabolic_peaks(spectra, return_value=False):
+    '''
+    spectra - 2D array with one correlation spectrum per row
+    Returns the position of the maximum of each row, refined by the vertex of the parabola
+    going through the peak and its two neighbors. This is the same as extrapolate, but for all rows at once.
+    Peaks on the first or last element only have one neighbor and are not refined.
+    Rows without a finite peak, such as the nans of a flat bundle, give nan.
+    '''
+
+    spectra = np.atleast_2d(spectra)
+    rows = np.arange(spectra.shape[0])
+    last = spectra.shape[1] - 1
+
+    peak = spectra.argmax(axis=1)
+    center = spectra[rows, peak]
+    left = spectra[rows, np.maximum(peak - 1, 0)]
+    right = spectra[rows, np.minimum(peak + 1, last)]
+
+    # parabola a * x**2 + b * x + c going through (-1, left), (0, center) and (1, right)
+    a = (left + right) / 2 - center
+    b = (right - left) / 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = -b / (2 * a)
+
+    edges = (peak == 0) | (peak == last)
+    offset[edges] = 0
+
+    peaks = peak + offset
+    peaks[~np.isfinite(center)] = np.nan
+
+    if return_value:
+        values = center + b * offset / 2
+        values[edges] = center[edges]
+        return peaks, values
+    return peaks
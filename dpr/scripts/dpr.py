@@ -1,20 +1,45 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 import argparse
+import csv
+import io
+import json
 import logging
 import os
+import sys
 
-from dpr.register import align_bundles, resample_bundles_to_same, flip_fibers, truncate
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr
+from time import perf_counter
+
+from dpr.cache import ShiftsCache
+from dpr.register import DPR, flip_fibers
+from dpr.state import AlignmentState
 
 # These are a few reading functions for text file I made, feel free to use them if they fit your data
-from dpr.utils import read_per_line, strip_first_col, strip_header
+from dpr.utils import load_bundles, load_streamlines, read_per_line, save_bundles, strip_first_col, strip_header
 
 
 DESCRIPTION = """
 Main script for the diffusion profile realignment (DPR) algorithm.
+
+Use dpr batch manifest to run many inputs at once, see dpr batch --help.
 """
 
+BATCH_DESCRIPTION = """
+Runs the dpr script on every row of a manifest, in a pool of processes.
+
+The manifest is either a csv file with a header or a json list of objects. Each row needs an input and an output,
+and the other columns or keys are the options of the dpr script without the leading dashes, such as points or exploredti.
+Options without a value are set with true and skipped with false or an empty cell,
+and options with many values such as metrics are separated by ; in a csv file or given as a list in a json file.
+
+Each job writes its output as soon as it is done, and one line per job is added to the report as they finish.
+A failed job is reported, but does not stop the others.
+"""
+
+logger = logging.getLogger('diffusion profile realignment')
+
 EPILOG = """
 Reference :
 
@@ -32,15 +57,17 @@ def buildArgsParser():
                                 formatter_class=argparse.RawTextHelpFormatter)
 
     p.add_argument('data', metavar='input',
-                   help='Path of the input text file of bundles.')
+                   help='Path of the input text file of bundles.'
+                   '\nA .npy or .npz file (with the name of each subject stored alongside) is also read as is.')
 
     p.add_argument('output', metavar='output',
-                   help='Path of the output text file of realigned bundles.')
+                   help='Path of the output text file of realigned bundles.'
+                   '\nA .npy or .npz file (with the name of each subject stored alongside) is also written as is.')
 
     p.add_argument('--exploredti', action='store_true',
                    help='Strip the first column from the input file as used by explore dti to store each subject name.')
 
-    p.add_argument('--do_graph', action='store_true',
+    p.add_argument('--do_graph', '--do-graph', action='store_true',
                    help='Save a small plot of the original and realigned data.')
 
     p.add_argument('--points', metavar='int', type=int,
@@ -48,8 +75,40 @@ def buildArgsParser():
 
     p.add_argument('--coordinates', metavar='input',
                    help='Text file with the xyz coordinates of each bundle to determine the initial system of coordinates.'
+                   '\nOne point per line with a blank line after each bundle, or a .npz file of Streamlines.save.'
                    '\nUseful if your data is not already in increasing order.')
 
+    p.add_argument('--metrics', metavar='input', nargs='+', default=[],
+                   help='Text files of other metrics for the same bundles, which are all realigned with the same shifts.')
+
+    p.add_argument('--metrics-output', metavar='output', nargs='+', default=[],
+                   help='Path of the output text file of each realigned metric, in the same order as --metrics.')
+
+    p.add_argument('--reference', metavar='int', type=int,
+                   help='Metric used to find the shifts with --metrics, 0 being the input and 1 the first of --metrics.'
+                   '\nDefault: sum the cross power spectra of all the metrics')
+
+    p.add_argument('--save-model', metavar='file',
+                   help='Save the shifts in this file, to realign other metrics of the same bundles with --apply-model.')
+
+    p.add_argument('--apply-model', metavar='file',
+                   help='Realign the input with the shifts saved by --save-model instead of finding them again.'
+                   '\nThe bundles must be the same and in the same order.')
+
+    p.add_argument('--update', metavar='state',
+                   help='Add the input bundles to the cohort saved in this file and realign all of them.'
+                   '\nThe file is created on the first run and updated afterwards, so only the new bundles are compared.')
+
+    p.add_argument('--cache-dir', metavar='dir',
+                   help='Keep the spectra and shifts in this directory, so running again on the same input'
+                   '\nwith e.g. a different number of points does not compute them again.')
+
+    p.add_argument('--cache-size', metavar='MB', type=float, default=1024,
+                   help='Size of the cache directory before the least recently used files are removed. Default: 1024')
+
+    p.add_argument('-j', '--jobs', metavar='int', type=int, default=1,
+                   help='Number of threads used to compare the bundles, -1 uses all the cores. Default: 1')
+
     p.add_argument('-f', '--force', action='store_true', dest='overwrite',
                    help='If set, overwrites the output text file if it already exists.')
 
@@ -62,11 +121,35 @@ def buildArgsParser():
     return p
 
 
-def main():
-    parser = buildArgsParser()
-    args = parser.parse_args()
+def buildBatchArgsParser():
 
-    logger = logging.getLogger('diffusion profile realignment')
+    p = argparse.ArgumentParser(prog='dpr batch',
+                                description=BATCH_DESCRIPTION,
+                                epilog=EPILOG,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('manifest', metavar='manifest',
+                   help='Path of the csv or json file listing the jobs.')
+
+    p.add_argument('--workers', metavar='int', type=int,
+                   help='Number of processes running the jobs. Default: number of cores')
+
+    p.add_argument('--report', metavar='file',
+                   help='Save the status and time of each job in this csv file as they finish.')
+
+    p.add_argument('-f', '--force', action='store_true', dest='overwrite',
+                   help='If set, overwrites the output text files of all the jobs if they already exist.')
+
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+                   help='If set, print useful information during processing.')
+
+    p.add_argument('-l', '--log', dest='logfile', metavar='file',
+                   help='Save the logging output to this file. Implies verbose output.')
+
+    return p
+
+
+def setup_logging(args):
 
     if args.logfile is not None:
         handler = logging.FileHandler(args.logfile)
@@ -78,49 +161,252 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+    # also show the messages from the library itself
+    library_logger = logging.getLogger('dpr')
+    library_logger.addHandler(handler)
+
     if args.verbose:
         logger.setLevel(logging.INFO)
+        library_logger.setLevel(logging.INFO)
         logger.info('Verbosity is on')
 
-    if os.path.isfile(args.output):
-        if args.overwrite:
-            logger.warning(f'Overwriting {os.path.realpath(args.output)}')
+
+def read_manifest(fname):
+    '''
+    Command line arguments of the dpr script for each job of a csv or json manifest.
+    '''
+
+    _, ext = os.path.splitext(fname)
+
+    with open(fname, newline='') as file:
+        if ext == '.json':
+            rows = json.load(file)
         else:
-            parser.error(f'{args.output} already exists! Use -f or --force to overwrite it.')
+            # the missing cells of a short row are None, like an empty cell
+            rows = [{key: value.split(';') if value is not None and ';' in value else value for key, value in row.items()}
+                    for row in csv.DictReader(file)]
 
-    # load the data
-    _, ext = os.path.splitext(args.data)
+    jobs = []
 
-    if ext == '.csv':
-        delimiter = ','
-    else:
-        delimiter = None
+    for row in rows:
+        row = dict(row)
+        fnames = row.pop('input', None), row.pop('output', None)
 
-    if args.exploredti:
-        data, header = strip_header(args.data, delimiter=delimiter)
-    else:
-        data = np.genfromtxt(args.data, delimiter=delimiter)
+        # a row without an input or output is reported as a failed job by run_job
+        argv = ['' if fname is None else str(fname) for fname in fnames]
+
+        for key, value in row.items():
+            flag = '--' + key.strip().replace('_', '-')
+
+            if isinstance(value, str) and value.strip().lower() in ('true', 'false', ''):
+                value = value.strip().lower() == 'true'
+
+            if value is True:
+                argv.append(flag)
+            elif value is False or value is None:
+                continue
+            elif isinstance(value, list):
+                argv += [flag] + [str(item) for item in value]
+            else:
+                argv += [flag, str(value)]
+
+        jobs.append(argv)
+
+    return jobs
+
+
+def run_job(argv):
+    '''
+    Runs the dpr script with these arguments and returns the time it took and the error if it failed.
+    '''
+
+    start = perf_counter()
+
+    if argv[0] == '' or argv[1] == '':
+        return perf_counter() - start, 'The manifest row needs both an input and an output'
+
+    parser = buildArgsParser()
+    stderr = io.StringIO()
+
+    try:
+        # argparse exits on errors, so we keep its message for the report instead
+        with redirect_stderr(stderr):
+            args = parser.parse_args(argv)
+            realign(args, parser)
+    except SystemExit:
+        return perf_counter() - start, stderr.getvalue().strip().splitlines()[-1]
+    except Exception as e:
+        return perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    return perf_counter() - start, None
+
+
+def _init_worker(args):
+
+    # forked workers already have the handlers of the main process, but spawned ones start from scratch
+    if not logger.handlers:
+        setup_logging(args)
+
+
+def batch(argv):
+    parser = buildBatchArgsParser()
+    args = parser.parse_args(argv)
+    setup_logging(args)
+
+    jobs = read_manifest(args.manifest)
+
+    if args.overwrite:
+        jobs = [argv + ['--force'] for argv in jobs]
+
+    logger.info(f'Running {len(jobs)} jobs from {args.manifest}')
+
+    report = None
+    failures = 0
+
+    if args.report is not None:
+        report = open(args.report, 'w', newline='')
+        writer = csv.writer(report)
+        writer.writerow(['input', 'output', 'status', 'seconds', 'error'])
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+            futures = {pool.submit(run_job, argv): argv for argv in jobs}
+
+            for future in as_completed(futures):
+                argv = futures[future]
+
+                try:
+                    seconds, error = future.result()
+                except Exception as e:  # the worker itself died
+                    seconds, error = float('nan'), f'{type(e).__name__}: {e}'
+
+                if error is None:
+                    logger.info(f'Realigned {argv[0]} to {argv[1]} in {seconds:.2f} s')
+                else:
+                    failures += 1
+                    logger.error(f'Failed to realign {argv[0]} after {seconds:.2f} s: {error}')
+
+                if report is not None:
+                    writer.writerow([argv[0], argv[1], 'failed' if error else 'done', f'{seconds:.3f}', error or ''])
+                    report.flush()
+    finally:
+        if report is not None:
+            report.close()
+
+    logger.info(f'{len(jobs) - failures} jobs done and {failures} failed')
+
+    return 1 if failures > 0 else 0
+
+
+def main():
+
+    # the batch mode has its own arguments, which are then passed to each job
+    if sys.argv[1:2] == ['batch']:
+        return batch(sys.argv[2:])
+
+    parser = buildArgsParser()
+    args = parser.parse_args()
+    setup_logging(args)
+    realign(args, parser)
+
+
+def realign(args, parser):
+
+    if len(args.metrics) != len(args.metrics_output):
+        parser.error(f'--metrics has {len(args.metrics)} files, but --metrics-output has {len(args.metrics_output)}')
+
+    if args.update is not None and (len(args.metrics) > 0 or args.save_model is not None or args.apply_model is not None):
+        parser.error('--metrics, --save-model and --apply-model can not be used with --update')
+
+    if args.update is not None and (args.cache_dir is not None or args.reference is not None):
+        parser.error('--cache-dir and --reference can not be used with --update')
+
+    for output in [args.output] + args.metrics_output:
+        if os.path.isfile(output):
+            if args.overwrite:
+                logger.warning(f'Overwriting {os.path.realpath(output)}')
+            else:
+                parser.error(f'{output} already exists! Use -f or --force to overwrite it.')
+
+    # load the data, a .npy file is memory mapped so it is only read a block at a time
+    data, header = load_bundles(args.data, exploredti=args.exploredti, mmap_mode='r')
+    metrics = [load_bundles(fname, exploredti=args.exploredti, mmap_mode='r') for fname in args.metrics]
+
+    for fname, (metric, _) in zip(args.metrics, metrics):
+        if metric.shape != data.shape:
+            parser.error(f'{fname} has shape {metric.shape}, but {args.data} has shape {data.shape}')
 
     logger.info(f'Number of bundles is {data.shape[0]}, original number of points per tract is {data.shape[1]}')
 
     if args.coordinates is not None:
-        coordinates = np.genfromtxt(args.coordinates)
+        coordinates = load_streamlines(args.coordinates)
         data = flip_fibers(data, coordinates)
+        metrics = [(flip_fibers(metric, coordinates), metric_header) for metric, metric_header in metrics]
+
+    # resample so that the number of points is the same as the truncated bundles or as requested
+    if args.update is None:
+        if args.cache_dir is not None:
+            cache = ShiftsCache(args.cache_dir, max_size=int(args.cache_size * 2**20))
+        else:
+            cache = None
+
+        # all the metrics go through the same fft stage and are realigned together
+        if len(metrics) > 0:
+            bundles = np.stack([data] + [metric for metric, _ in metrics])
+            logger.info(f'Realigning {len(bundles)} metrics together')
+        else:
+            bundles = data
+
+        if args.apply_model is not None:
+            model = DPR.load(args.apply_model)
+            logger.info(f'Using the shifts from {args.apply_model}')
+
+            if len(model.shifts_) != data.shape[0]:
+                parser.error(f'{args.apply_model} has shifts for {len(model.shifts_)} bundles, but there are {data.shape[0]}')
 
-    aligned, shifts = align_bundles(data)
-    truncated = truncate(aligned)
+            if args.points is not None:
+                model.num_points = args.points
+        else:
+            model = DPR(truncation='shortest', num_points=args.points, cache_dir=cache, n_jobs=args.jobs,
+                        reference=args.reference).fit(bundles)
+
+        if args.save_model is not None:
+            model.save(args.save_model)
+
+        # a single .npy output is directly written to disk instead of being kept in memory
+        if len(metrics) == 0 and os.path.splitext(args.output)[1] == '.npy':
+            out = args.output
+        else:
+            out = None
 
-    # resample so that the number of points is the same as the original file or as requested
-    if args.points is None:
-        num_points = truncated.shape[1]
+        realigned = model.transform(bundles, out=out)
+
+        if len(metrics) > 0:
+            resampled = realigned[0]
+
+            for fname, (_, metric_header), metric in zip(args.metrics_output, metrics, realigned[1:]):
+                save_bundles(fname, metric, subjects=metric_header)
+        else:
+            resampled = realigned
     else:
-        num_points = args.points
+        if os.path.isfile(args.update):
+            state = AlignmentState.load(args.update)
+            logger.info(f'Adding to the {len(state)} bundles from {args.update}')
+        else:
+            state = AlignmentState()
+
+        state.add(data, subjects=header, n_jobs=args.jobs)
 
-    resampled = resample_bundles_to_same(truncated, num_points=num_points)
+        # the output has the whole cohort, not only the new bundles
+        data = state.bundles
+        header = state.subjects if header is not None else None
+        resampled = state.realign(truncation='shortest', num_points=args.points)
 
-    logger.info(f'Final number of points per tract is {num_points}')
+    logger.info(f'Final number of points per tract is {resampled.shape[1]}')
 
     if args.do_graph:
+        import matplotlib.pyplot as plt
+
         f, axes = plt.subplots(2, 1, sharex=False, sharey=True)
         labels = 'Before realignment', 'After realignment'
 
@@ -136,18 +422,13 @@ def main():
             ax.set(ylabel='Metric', xlabel='Coordinates')
 
         f.tight_layout()
-        f.savefig(args.output.replace('.txt','.png'), dpi=100, bbox_inches='tight')
+        f.savefig(os.path.splitext(args.output)[0] + '.png', dpi=100, bbox_inches='tight')
+        plt.close(f)
 
-    # should patch back whatever was removed beforehand here
-    if args.exploredti:
-        resampled = np.column_stack((header, resampled))
-
-    _, ext = os.path.splitext(args.output)
-
-    if ext == '.csv':
-        delimiter = ','
-    else:
-        delimiter = ' '
+    # otherwise it was already written by transform
+    if not isinstance(resampled, np.memmap):
+        save_bundles(args.output, resampled, subjects=header)
 
-    with open(args.output, 'w') as file:
-        np.savetxt(file, resampled, delimiter=delimiter, fmt='%s')
+    # the state is only updated once the output is written, so a failed run can be done again as is
+    if args.update is not None:
+        state.save(args.update)
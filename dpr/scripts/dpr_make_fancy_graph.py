@@ -4,7 +4,8 @@ import argparse
 import logging
 import os
 
-from dpr.utils import draw_fancy_graph, read_per_line
+from dpr.plotting import draw_fancy_graph
+from dpr.utils import load_streamlines
 from ast import literal_eval
 
 
@@ -33,10 +34,10 @@ def buildArgsParser():
                    help='Path of the input text file to overlay.')
 
     p.add_argument('coords',
-                   help='Path of the input text file for the whole coordinates.')
+                   help='Path of the input text file for the whole coordinates, or a .npz file of Streamlines.save.')
 
     p.add_argument('truncated',
-                   help='Path of the input text file for the x axis coordinates between rois.')
+                   help='Path of the input text file for the x axis coordinates between rois, or a .npz file of Streamlines.save.')
 
     p.add_argument('representative',
                    help='Path of the input text file providing the representative streamline on the x axis.')
@@ -107,14 +108,14 @@ def main():
     representative1 = representative[:, axis1]
     representative2 = representative[:, axis2]
 
-    # Load up the text files which are lists of various points
-    coords = read_per_line(args.coords)
-    coords1 = [coords[i][:, axis1] for i in range(len(coords))]
-    coords2 = [coords[i][:, axis2] for i in range(len(coords))]
+    # Load up the files which are lists of various points
+    coords = load_streamlines(args.coords)
+    coords1 = coords.column(axis1)
+    coords2 = coords.column(axis2)
 
-    truncated = read_per_line(args.truncated)
-    truncated1 = [truncated[i][:, axis1] for i in range(len(truncated))]
-    truncated2 = [truncated[i][:, axis2] for i in range(len(truncated))]
+    truncated = load_streamlines(args.truncated)
+    truncated1 = truncated.column(axis1)
+    truncated2 = truncated.column(axis2)
 
     # Finally draw up everything
     fig, axes = draw_fancy_graph(pvals, coords1, coords2, truncated1, truncated2, representative1, representative2,
@@ -0,0 +1,186 @@
+import numpy as np
+
+from warnings import warn
+
+from dpr.condensed import CondensedShifts
+from dpr.register import get_fft_length, get_ffts, get_shifts_from_ffts, relay_outliers, _apply_shifts, _pick_template
+
+
+class AlignmentState:
+    '''
+    Spectra, shifts matrix, overlap counts and template of a cohort of bundles, which are kept so that new bundles
+    can be added later by only correlating them with the ones already there. The options are the same as align_bundles
+    in full_template mode, and adding all the bundles at once or in several steps gives the same template and shifts.
+
+    Use add to put in new bundles, realign to get all the realigned bundles and save or load to keep it on disk.
+    '''
+
+    def __init__(self, percent=15, padding=0., eps=1e-5, remove_outliers=True, remove_baseline=True, whiten=True,
+                 normalize=False, rematch_outliers=True, fft_length='pow2', block_size=4096):
+
+        self.percent = percent
+        self.padding = padding
+        self.eps = eps
+        self.remove_outliers = remove_outliers
+        self.remove_baseline = remove_baseline
+        self.whiten = whiten
+        self.normalize = normalize
+        self.rematch_outliers = rematch_outliers
+        self.fft_length = fft_length
+        self.block_size = block_size
+
+        self.bundles = None
+        self.subjects = np.zeros(0, dtype=str)
+        self.ffts = None
+        self.shifts = CondensedShifts(0)
+        self.sumstuff = np.zeros(0, dtype=np.intp)
+        self.template = None
+        self.template_shifts = np.zeros(0)
+
+    def __len__(self):
+        return 0 if self.bundles is None else len(self.bundles)
+
+    @property
+    def maxoverlaps(self):
+        return np.ceil(self.percent * np.isfinite(self.bundles).sum(axis=1) / 100)
+
+    def add(self, bundles, subjects=None, n_jobs=1):
+        '''
+        Adds new bundles, which can not have more points than the first ones, then updates the template.
+
+        bundles - 2D array of bundles, padded like the others
+        subjects - optional name of each bundle, to keep track of them in the output.
+            The subjects which are already in the cohort are skipped with a warning.
+        n_jobs - number of threads correlating the new pairs, -1 uses all the cores
+        '''
+
+        bundles = np.array(bundles, dtype=np.float64, copy=True, ndmin=2)
+        bundles[bundles == self.padding] = np.nan
+
+        if subjects is None:
+            subjects = np.full(len(bundles), '')
+
+        subjects = np.asarray(subjects, dtype=str)
+        named = subjects != ''
+        names, counts = np.unique(subjects[named], return_counts=True)
+
+        if np.any(counts > 1):
+            raise ValueError(f'Subjects {names[counts > 1]} are given more than once')
+
+        # adding the same subjects again, e.g. when running the same update twice, would count them twice for the template
+        known = named & np.isin(subjects, self.subjects[self.subjects != ''])
+
+        if np.any(known):
+            warn(f'Skipping the subjects already in the cohort {subjects[known]}')
+            bundles = bundles[~known]
+            subjects = subjects[~known]
+
+            if len(bundles) == 0:
+                return self
+
+        if self.bundles is None:
+            # the length of the transforms is fixed by the first bundles, so the spectra can be reused
+            self.fft_length = get_fft_length(bundles.shape[1], fft_length=self.fft_length)
+            self.bundles = np.zeros((0, bundles.shape[1]))
+            self.ffts = np.zeros((0, self.fft_length // 2 + 1), dtype=np.complex128)
+
+        width = self.bundles.shape[1]
+
+        if bundles.shape[1] > width:
+            error = f'New bundles can have at most {width} points, but have {bundles.shape[1]}'
+            raise ValueError(error)
+
+        bundles = np.pad(bundles, ((0, 0), (0, width - bundles.shape[1])), constant_values=np.nan)
+
+        old = len(self)
+        total = old + len(bundles)
+
+        self.ffts = np.concatenate((self.ffts, get_ffts(bundles, whiten=self.whiten, remove_baseline=self.remove_baseline,
+                                                         fft_length=self.fft_length)))
+        self.bundles = np.concatenate((self.bundles, bundles))
+        self.subjects = np.concatenate((self.subjects, subjects))
+
+        # the existing rows keep their shifts, which come first in their new (longer) row of the condensed matrix
+        shifts = CondensedShifts(total, dtype=self.shifts.dtype)
+
+        for i in range(old):
+            length = old - i - 1
+            start = old * i - i * (i + 1) // 2
+            new_start = total * i - i * (i + 1) // 2
+            shifts.data[new_start:new_start + length] = self.shifts.data[start:start + length]
+
+        # we only need to correlate the pairs with a new bundle, which is always the larger index
+        new_rows, new_cols = np.triu_indices(total - old, 1)
+        rows = np.concatenate((np.repeat(np.arange(old), total - old), new_rows + old))
+        cols = np.concatenate((np.tile(np.arange(old, total), old), new_cols + old))
+
+        values = get_shifts_from_ffts(self.ffts, rows, cols, normalize=self.normalize, block_size=self.block_size,
+                                      n=self.fft_length, n_jobs=n_jobs)
+        values[np.abs(values) < self.eps] = 0.  # force symmetry at ~zero shift
+        shifts[rows, cols] = values
+        self.shifts = shifts
+
+        # the old counts only miss the new columns, while the new rows also count their diagonal
+        maxoverlaps = self.maxoverlaps
+        sumstuff = np.zeros(total, dtype=np.intp)
+        sumstuff[:old] = self.sumstuff
+        sumstuff[old:] = 0 < maxoverlaps[old:]
+        sumstuff += np.bincount(rows, weights=np.abs(values) < maxoverlaps[cols], minlength=total).astype(np.intp)
+        sumstuff += np.bincount(cols, weights=np.abs(values) < maxoverlaps[rows], minlength=total).astype(np.intp)
+        self.sumstuff = sumstuff
+
+        self._update_template()
+        return self
+
+    def _update_template(self):
+
+        maxoverlaps = self.maxoverlaps
+        template = _pick_template(self.shifts, self.sumstuff)
+        template_shifts = self.shifts[template]
+
+        if self.rematch_outliers:
+            # only the row of the template is modified, so we put it back to keep the shifts as they were computed
+            relay_outliers(self.shifts, template, maxoverlaps)
+            template_shifts, self.shifts[template] = self.shifts[template], template_shifts
+        else:
+            outliers = np.flatnonzero(np.abs(template_shifts) > maxoverlaps)
+            template_shifts[outliers] = np.nan if self.remove_outliers else 0.
+            warn(f'Possible outliers found {outliers}')
+
+        self.template = template
+        self.template_shifts = template_shifts
+
+    def realign(self, order=1, truncation=None, num_points=None):
+        '''
+        Realigned bundles of the whole cohort, as returned by align_bundles with the same options.
+        '''
+        return _apply_shifts(self.bundles, self.template_shifts, order=order, truncation=truncation, num_points=num_points)
+
+    def save(self, fname):
+
+        options = dict(percent=self.percent, padding=self.padding, eps=self.eps, remove_outliers=self.remove_outliers,
+                       remove_baseline=self.remove_baseline, whiten=self.whiten, normalize=self.normalize,
+                       rematch_outliers=self.rematch_outliers, fft_length=self.fft_length, block_size=self.block_size)
+
+        # a file object prevents numpy from adding .npz to the name
+        with open(fname, 'wb') as file:
+            np.savez(file, bundles=self.bundles, subjects=self.subjects, ffts=self.ffts, shifts=self.shifts.data,
+                     sumstuff=self.sumstuff, template=self.template, template_shifts=self.template_shifts, **options)
+
+    @classmethod
+    def load(cls, fname):
+
+        with np.load(fname) as data:
+            options = ['percent', 'padding', 'eps', 'remove_outliers', 'remove_baseline', 'whiten', 'normalize',
+                       'rematch_outliers', 'fft_length', 'block_size']
+            state = cls(**{option: data[option].item() for option in options})
+
+            state.bundles = data['bundles']
+            state.subjects = data['subjects']
+            state.ffts = data['ffts']
+            state.shifts = CondensedShifts(len(state.bundles), dtype=data['shifts'].dtype, data=data['shifts'])
+            state.sumstuff = data['sumstuff']
+            state.template = data['template'].item()
+            state.template_shifts = data['template_shifts']
+
+        return state
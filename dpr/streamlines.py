@@ -0,0 +1,121 @@
+import numpy as np
+
+from itertools import islice
+
+
+class Streamlines:
+    '''
+    Ragged list of streamlines with all their points packed in a single contiguous buffer,
+    where streamline i is points[offsets[i]:offsets[i] + lengths[i]].
+
+    It can be indexed and iterated like the list of arrays it replaces, which gives views of the buffer,
+    but without a python object per streamline and with the first and last points of all the streamlines at once.
+
+    points - array of shape (total number of points, 3), or (total number of points,) for a single coordinate
+    lengths - number of points of each streamline, which must sum to the number of points
+    dtype - type used to store the points
+    '''
+
+    def __init__(self, points, lengths, dtype=np.float32):
+        self.points = np.asarray(points, dtype=dtype)
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+
+        if self.lengths.sum() != len(self.points):
+            error = f'lengths should sum to the {len(self.points)} points, but sum to {self.lengths.sum()}'
+            raise ValueError(error)
+
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+
+    @classmethod
+    def from_list(cls, streamlines, dtype=np.float32):
+        lengths = [len(streamline) for streamline in streamlines]
+
+        if len(streamlines) == 0:
+            return cls(np.zeros((0, 3)), lengths, dtype=dtype)
+
+        return cls(np.concatenate(streamlines), lengths, dtype=dtype)
+
+    @classmethod
+    def read(cls, fname, dtype=np.float32, maxlines=None):
+        '''
+        Reads a text file with one point per line and a blank line after each streamline.
+        All the numbers are parsed at once, and the blank lines only give the length of each streamline.
+
+        maxlines - only read this many lines and keep the streamlines whose blank line is among them, or read everything if None
+        '''
+
+        with open(fname, 'r') as file:
+            if maxlines is None:
+                lines = file.read().splitlines()
+            else:
+                lines = [line.rstrip('\r\n') for line in islice(file, maxlines)]
+
+        blank = np.array([not line.strip() for line in lines], dtype=bool)
+
+        # the last streamline may be cut by maxlines, so it is dropped
+        if maxlines is not None:
+            lines = lines[:np.flatnonzero(blank)[-1] + 1] if blank.any() else []
+            blank = blank[:len(lines)]
+
+        if blank.all():
+            return cls(np.zeros((0, 3)), [], dtype=dtype)
+
+        # numpy skips the blank lines by itself
+        points = np.loadtxt(lines, dtype=dtype, ndmin=2)
+
+        # a single coordinate per line is kept as a 1D array
+        if points.shape[1] == 1:
+            points = points[:, 0]
+
+        # each point belongs to the streamline after the number of blank lines before it, empty ones are skipped
+        streamline = np.cumsum(blank)[~blank]
+        lengths = np.bincount(streamline)
+
+        return cls(points, lengths[lengths > 0], dtype=dtype)
+
+    def save(self, fname):
+
+        # a file object prevents numpy from adding .npz to the name
+        with open(fname, 'wb') as file:
+            np.savez(file, points=self.points, lengths=self.lengths)
+
+    @classmethod
+    def load(cls, fname):
+
+        with np.load(fname) as data:
+            return cls(data['points'], data['lengths'], dtype=data['points'].dtype)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        idx = range(len(self))[idx]
+
+        if isinstance(idx, range):
+            return [self[i] for i in idx]
+
+        return self.points[self.offsets[idx]:self.offsets[idx] + self.lengths[idx]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def column(self, axis):
+        '''
+        Streamlines with only one of the coordinates, sharing the same lengths.
+        '''
+        return Streamlines(self.points[:, axis], self.lengths, dtype=self.points.dtype)
+
+    @property
+    def first(self):
+        '''
+        First point of each streamline.
+        '''
+        return self.points[self.offsets]
+
+    @property
+    def last(self):
+        '''
+        Last point of each streamline.
+        '''
+        return self.points[self.offsets + self.lengths - 1]
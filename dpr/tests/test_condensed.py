@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from dpr.condensed import CondensedShifts
+
+
+def antisymmetric(size, seed=42):
+    shifts = np.random.default_rng(seed).normal(scale=10, size=(size, size))
+    return np.triu(shifts, 1) - np.triu(shifts, 1).T
+
+
+def test_indexing():
+    dense = antisymmetric(7)
+    shifts = CondensedShifts.from_dense(dense)
+    rows = np.array([0, 3, 6])
+    cols = np.array([1, 3, 2, 0])
+
+    assert shifts.shape == dense.shape
+    np.testing.assert_equal(shifts.todense(), dense)
+    np.testing.assert_equal(np.asarray(shifts), dense)
+    np.testing.assert_equal(shifts[4], dense[4])
+    np.testing.assert_equal(shifts[-1], dense[-1])
+    np.testing.assert_equal(shifts[rows], dense[rows])
+    np.testing.assert_equal(shifts[:, cols], dense[:, cols])
+    np.testing.assert_equal(shifts[:, 2], dense[:, 2])
+    np.testing.assert_equal(shifts[np.ix_(rows, cols)], dense[np.ix_(rows, cols)])
+    np.testing.assert_equal(shifts[rows, 5], dense[rows, 5])
+    assert shifts[5, 2] == dense[5, 2]
+    assert shifts[3, 3] == 0
+
+    with pytest.raises(IndexError):
+        shifts[7, 0]
+
+
+def test_setitem():
+    dense = antisymmetric(6)
+    shifts = CondensedShifts.from_dense(dense, dtype=np.float32)
+
+    shifts[np.array([1, 4]), 2] = [5, -3]
+    dense[[1, 4], 2] = [5, -3]
+    dense[2, [1, 4]] = [-5, 3]
+
+    shifts[3] = np.nan
+    dense[3] = np.nan
+    dense[:, 3] = np.nan
+    dense[3, 3] = 0
+
+    assert shifts.nbytes == 15 * 4
+    np.testing.assert_allclose(shifts.todense(), dense, rtol=1e-6)
+
+
+def test_count_within():
+    dense = antisymmetric(50)
+    shifts = CondensedShifts.from_dense(dense)
+    thresholds = np.random.default_rng(0).uniform(0, 20, 50)
+
+    np.testing.assert_equal(shifts.count_within(thresholds, block_size=7), np.sum(np.abs(dense) < thresholds, axis=1))
+    np.testing.assert_equal(shifts.max_abs(block_size=7), np.max(np.abs(dense), axis=1))
+
+    # the nans of an outlier are never within the threshold and propagate to the largest shift
+    dense[4] = np.nan
+    dense[:, 4] = np.nan
+    dense[4, 4] = 0
+    shifts = CondensedShifts.from_dense(dense)
+
+    np.testing.assert_equal(shifts.count_within(thresholds, block_size=7), np.sum(np.abs(dense) < thresholds, axis=1))
+    np.testing.assert_equal(shifts.max_abs(block_size=7), np.max(np.abs(dense), axis=1))
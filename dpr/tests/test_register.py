@@ -1,6 +1,17 @@
 import numpy as np
+import pytest
 
-from dpr.register import truncate, extrapolate
+from contextlib import nullcontext
+from pathlib import Path
+
+from dpr.cache import ShiftsCache
+from dpr.register import DPR, align_bundles, truncate, extrapolate, get_ffts, get_shift_from_fft, get_shifts_from_ffts, parabolic_peaks, get_fft_length, \
+    preprocess_bundles, get_shifts_from_signals, choose_backend, \
+    get_pairwise_shifts, downsample_bundles, apply_shift, _spline_shift_row, \
+    shift_truncate_resample, resample_bundles_to_same, relay_outliers, filter_pairs, pair_indices, iter_pairs, flip_fibers, \
+    iter_pairwise_shifts
+
+datasets = Path(__file__).parents[2] / Path("datasets")
 
 
 def test_extrapolate():
@@ -35,3 +46,459 @@ def test_truncate():
     answer[0, range(4)] = range(2, 6)
     answer[1, range(2, 5)] = range(4, 7)
     np.testing.assert_equal(truncate(c, mode="longest"), answer)
+
+
+def test_get_shifts_from_ffts():
+    bundles = np.loadtxt(datasets / "bundles.txt")[:20]
+    bundles[bundles == 0] = np.nan
+    ffts = get_ffts(bundles)
+
+    rows, cols = np.indices((len(bundles), len(bundles))).reshape(2, -1)
+    expected = [get_shift_from_fft(ffts[a], ffts[b]) for a, b in zip(rows, cols)]
+
+    # a block size that does not divide the number of pairs
+    shifts = get_shifts_from_ffts(ffts, rows, cols, block_size=33)
+    np.testing.assert_allclose(shifts, expected, rtol=0, atol=1e-8)
+
+
+def test_align_bundles_antisymmetry():
+    bundles = np.loadtxt(datasets / "bundles.txt")
+
+    # everything correlates all the pairs, full_template only the upper triangle
+    aligned, shifts, template = align_bundles(bundles, mode="full_template", return_shifts_matrix=True)
+    aligned_all, shifts_all, template_all = align_bundles(bundles, mode="everything", return_shifts_matrix=True)
+
+    assert template == template_all
+    np.testing.assert_equal(aligned, aligned_all)
+    np.testing.assert_allclose(shifts, shifts_all, rtol=0, atol=1e-8)
+
+
+def test_parabolic_peaks():
+    rng = np.random.default_rng(42)
+    spectra = rng.normal(size=(50, 32))
+    peaks, values = parabolic_peaks(spectra, return_value=True)
+
+    for spectrum, peak, value in zip(spectra, peaks, values):
+        p = spectrum.argmax()
+
+        if p == 0 or p == len(spectrum) - 1:
+            expected = p, spectrum[p]
+        else:
+            expected = extrapolate([p - 1, p, p + 1], spectrum[p - 1:p + 2], return_value=True)
+
+        np.testing.assert_allclose((peak, value), expected)
+
+    # peaks on the edges are not refined
+    spectra = np.array([[3., 2., 1., 0.], [0., 1., 2., 3.]])
+    np.testing.assert_equal(parabolic_peaks(spectra), [0, 3])
+
+
+def test_flat_bundle():
+    bundles = np.loadtxt(datasets / "bundles.txt")
+    bundles[5, bundles[5] != 0] = 3.
+
+    # a flat bundle has nothing to correlate, so its shifts are nan and it is not moved
+    ffts = get_ffts(np.where(bundles == 0, np.nan, bundles), remove_baseline=False)
+    assert np.isnan(get_shift_from_fft(ffts[5], ffts[6]))
+    assert np.isnan(parabolic_peaks(np.full((1, 8), np.nan))).all()
+
+    for kwargs in [{}, dict(backend='direct', max_lag=50)]:
+        _, shifts, template = align_bundles(bundles, remove_baseline=False, return_shifts_matrix=True, **kwargs)
+        ys, template_shifts = align_bundles(bundles, remove_baseline=False, **kwargs)
+
+        assert np.isnan(np.delete(shifts[5], 5)).all()
+        assert np.isnan(template_shifts[5])
+        np.testing.assert_equal(ys[5], apply_shift(np.where(bundles[5:6] == 0, np.nan, bundles[5:6]), [0])[0])
+
+
+def test_get_fft_length():
+    assert get_fft_length(130, fft_length="pow2") == 512
+    assert get_fft_length(130, fft_length="fast") == 270
+    assert get_fft_length(130, fft_length=301) == 301
+
+    with pytest.raises(ValueError):
+        get_fft_length(130, fft_length=200)
+
+
+@pytest.mark.parametrize("fft_length", ["fast", 417])
+def test_fft_length_shifts(fft_length):
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")[:20]
+    bundles[bundles == 0] = np.nan
+    rows, cols = np.indices((len(bundles), len(bundles))).reshape(2, -1)
+
+    expected = get_shifts_from_ffts(get_ffts(bundles), rows, cols)
+
+    n = get_fft_length(bundles.shape[1], fft_length=fft_length)
+    shifts = get_shifts_from_ffts(get_ffts(bundles, fft_length=n), rows, cols, n=n)
+    np.testing.assert_allclose(shifts, expected, rtol=0, atol=1e-8)
+
+
+def test_get_shifts_from_signals():
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")[:20]
+    bundles[bundles == 0] = np.nan
+    rows, cols = np.indices((len(bundles), len(bundles))).reshape(2, -1)
+    max_lag = 15
+
+    expected = get_shifts_from_ffts(get_ffts(bundles), rows, cols)
+    shifts = get_shifts_from_signals(preprocess_bundles(bundles), rows, cols, max_lag=max_lag, block_size=33)
+
+    inside = np.abs(expected) <= max_lag
+    assert np.any(~inside)
+    np.testing.assert_allclose(shifts[inside], expected[inside], rtol=0, atol=1e-8)
+    assert np.all(np.abs(shifts) <= max_lag + 1)
+
+
+def test_choose_backend():
+    assert choose_backend(200, 512) == "fft"
+    assert choose_backend(200, 512, max_lag=10) == "direct"
+    assert choose_backend(200, 512, max_lag=10, normalize=True) == "fft"
+    assert choose_backend(200, 512, max_lag=150) == "fft"
+
+
+def test_downsample_bundles():
+    bundles = np.array([[1, 2, 3, 4, 5, np.nan, np.nan], [1, np.nan, 3, 4, np.nan, np.nan, np.nan]])
+    answer = np.array([[1.5, 3.5, 5, np.nan], [1, 3.5, np.nan, np.nan]])
+    np.testing.assert_equal(downsample_bundles(bundles, 2), answer)
+
+
+def test_pyramid_shifts():
+    bundles = np.loadtxt(datasets / "bundles.txt")[:30]
+    bundles[bundles == 0] = np.nan
+    rows, cols = np.triu_indices(len(bundles), 1)
+
+    expected = get_pairwise_shifts(bundles, rows, cols)
+    shifts = get_pairwise_shifts(bundles, rows, cols, levels=3, refine_radius=2)
+    np.testing.assert_allclose(shifts, expected, rtol=0, atol=1e-8)
+
+    # a bundle with too few points for the coarse level has no shift, instead of one from a garbage center
+    bundles[7] = np.nan
+    bundles[7, :2] = 1., 2.
+    shifts = get_pairwise_shifts(bundles, rows, cols, levels=2, refine_radius=2)
+    pairs = (rows == 7) | (cols == 7)
+
+    assert np.isnan(shifts[pairs]).all()
+    np.testing.assert_allclose(shifts[~pairs], expected[~pairs], rtol=0, atol=1e-8)
+
+    signals = preprocess_bundles(bundles)
+    assert np.isnan(get_shifts_from_signals(signals, [0, 1], [1, 2], max_lag=2, centers=[np.nan, 0.])[0])
+
+    # the coarsest level needs at least two points
+    with pytest.raises(ValueError):
+        get_pairwise_shifts(bundles, rows, cols, levels=9)
+
+
+def test_iter_pairwise_shifts(monkeypatch):
+    bundles = np.loadtxt(datasets / "bundles.txt")[:30]
+    bundles[bundles == 0] = np.nan
+    rows, cols = pair_indices(len(bundles), 'half')
+
+    for levels in [1, 2]:
+        expected = get_pairwise_shifts(bundles, rows, cols, levels=levels)
+        tiles = list(iter_pairwise_shifts(bundles, iter_pairs(len(bundles), 'half', block_size=50), levels=levels))
+
+        assert len(tiles) > 1
+        np.testing.assert_equal(np.concatenate([tile[0] for tile in tiles]), rows)
+        np.testing.assert_equal(np.concatenate([tile[1] for tile in tiles]), cols)
+        np.testing.assert_allclose(np.concatenate([tile[2] for tile in tiles]), expected, rtol=0, atol=1e-8)
+
+    # align_bundles only goes through the tiles, so all the pairs are never in memory at once
+    expected = align_bundles(bundles, return_shifts_matrix=True, block_size=20)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('all the pairs were made')
+
+    monkeypatch.setattr('dpr.register.pair_indices', fail)
+
+    for condensed in [False, True]:
+        ys, shifts, template = align_bundles(bundles, return_shifts_matrix=True, block_size=20, condensed=condensed)
+        assert template == expected[2]
+        np.testing.assert_equal(ys, expected[0])
+        np.testing.assert_allclose(np.asarray(shifts), expected[1], rtol=0, atol=1e-8)
+
+
+def test_preprocess_bundles():
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")[:10]
+    bundles[bundles == 0] = np.nan
+    bundles[3, 5:9] = np.nan
+
+    expected = np.zeros_like(bundles)
+    for i, bundle in enumerate(bundles):
+        bundle = bundle[np.isfinite(bundle)]
+        line = np.linspace(0., np.sqrt(bundle.max()), len(bundle))
+        bundle = bundle - np.polyval(np.polyfit(line, bundle, 1), line)
+        expected[i, :len(bundle)] = (bundle - bundle.mean()) / bundle.std()
+
+    np.testing.assert_allclose(preprocess_bundles(bundles), expected, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize("order", [0, 1, 3])
+@pytest.mark.parametrize("padding", [np.nan, 0.])
+def test_apply_shift(order, padding):
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")[:40]
+    bundles[bundles == 0] = padding
+
+    rng = np.random.default_rng(42)
+    shifts = np.concatenate((rng.uniform(-60, 60, 30), [0, -0.5, 0.5, 2, np.nan, 250, -300, 1e-9, -1e-9, -3]))
+
+    expected = [_spline_shift_row(bundle, np.nan_to_num(shift), order=order, padding=padding)
+                for bundle, shift in zip(bundles, shifts)]
+
+    shifted = apply_shift(bundles, shifts, order=order, padding=padding, block_size=7)
+    np.testing.assert_equal(shifted, np.array(expected, dtype=np.float32))
+
+
+def test_apply_shift_fourier():
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")[:40]
+    bundles[bundles == 0] = np.nan
+    shifts = np.arange(-20, 20)
+
+    # integer shifts are exact with both, but the linear version also drops the last point
+    shifted = apply_shift(bundles, shifts, fourier=True)
+    expected = apply_shift(bundles, shifts)
+    finite = np.isfinite(expected)
+    np.testing.assert_allclose(shifted[finite], expected[finite], rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ["shortest", "longest", 50])
+@pytest.mark.parametrize("num_points", [None, 75])
+def test_shift_truncate_resample(mode, num_points):
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")
+    bundles[bundles == 0] = np.nan
+    shifts = np.random.default_rng(42).uniform(-30, 30, len(bundles))
+
+    expected = resample_bundles_to_same(truncate(apply_shift(bundles, shifts), mode=mode), num_points=num_points)
+    resampled = shift_truncate_resample(bundles, shifts, mode=mode, num_points=num_points, block_size=33)
+    np.testing.assert_equal(resampled, expected)
+
+
+@pytest.mark.parametrize("num_points", [1, 75, 208, 500])
+def test_resample_bundles_to_same(num_points):
+    bundles = np.loadtxt(datasets / "bundles_cut.txt").astype(np.float32)
+    bundles[bundles == 0] = np.nan
+
+    length = bundles.shape[1]
+    old_coord = np.linspace(1, length + 1, num=length, endpoint=True) / length
+    new_coord = np.linspace(1, length + 1, num=num_points, endpoint=True) / length
+    expected = [np.interp(new_coord, old_coord, bundle) for bundle in bundles]
+
+    np.testing.assert_equal(resample_bundles_to_same(bundles, num_points=num_points), expected)
+
+    out = np.zeros((len(bundles), num_points), dtype=np.float32)
+    resampled = resample_bundles_to_same(bundles, num_points=num_points, out=out)
+    assert resampled is out
+    np.testing.assert_equal(out, np.array(expected, dtype=np.float32))
+
+
+def test_relay_outliers():
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")
+    bundles[bundles == 0] = np.nan
+    maxoverlaps = np.ceil(15 * np.isfinite(bundles).sum(axis=1) / 100)
+
+    rows, cols = np.indices((len(bundles), len(bundles))).reshape(2, -1)
+    shifts = get_pairwise_shifts(bundles, rows, cols).reshape(len(bundles), len(bundles))
+    template = 78
+
+    # one pass of the previous loop over each outlier, which only uses a single relay
+    expected = shifts.copy()
+    outliers = np.flatnonzero(np.abs(expected[template]) > maxoverlaps)
+    candidates = np.flatnonzero(np.abs(expected[template]) <= maxoverlaps)
+    assert len(outliers) > 0
+
+    for outlier in outliers:
+        new_shifts = expected[template, :] + expected[:, outlier]
+        relay = [idx for idx in np.abs(new_shifts).argsort() if idx in candidates][0]
+        expected[outlier, template] = expected[outlier, relay] + expected[relay, template]
+        expected[template, outlier] = expected[template, relay] + expected[relay, outlier]
+
+    relay_outliers(shifts, template, maxoverlaps, max_iter=1, block_size=7)
+    np.testing.assert_equal(shifts, expected)
+
+
+@pytest.mark.parametrize("rematch_outliers", [True, False])
+def test_align_bundles_condensed(rematch_outliers):
+    bundles = np.loadtxt(datasets / "bundles_cut.txt")
+
+    with pytest.warns(UserWarning) if not rematch_outliers else nullcontext():
+        aligned, shifts, template = align_bundles(bundles, return_shifts_matrix=True, rematch_outliers=rematch_outliers)
+        aligned_condensed, condensed, template_condensed = align_bundles(bundles, return_shifts_matrix=True, condensed=True,
+                                                                         rematch_outliers=rematch_outliers)
+
+    # the diagonal of the outliers is set to nan in the full matrix
+    np.fill_diagonal(shifts, 0)
+
+    assert template == template_condensed
+    np.testing.assert_equal(aligned_condensed, aligned)
+    np.testing.assert_equal(condensed.todense(), shifts)
+
+
+@pytest.mark.parametrize("fname", ["bundles.txt", "bundles_cut.txt"])
+def test_align_bundles_subsample(fname):
+    bundles = np.loadtxt(datasets / fname)
+    aligned, shifts = align_bundles(bundles)
+
+    # using all the bundles as the subsample is the same as the exact version
+    aligned_subsample, shifts_subsample = align_bundles(bundles, subsample=len(bundles), seed=0)
+    np.testing.assert_allclose(shifts_subsample, shifts, rtol=0, atol=1e-8)
+    np.testing.assert_equal(aligned_subsample, aligned)
+
+    # and the same seed gives the same subsample
+    _, shifts1 = align_bundles(bundles, subsample=20, stratify=True, seed=3, validation=20)
+    _, shifts2 = align_bundles(bundles, subsample=20, stratify=True, seed=3, validation=20)
+    np.testing.assert_equal(shifts1, shifts2)
+
+
+def test_align_bundles_cache(tmp_path):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    ys, shifts = align_bundles(bundles)
+
+    # the first run fills the cache and the second one only reads from it
+    for _ in range(2):
+        ys_cache, shifts_cache = align_bundles(bundles, cache_dir=tmp_path)
+        np.testing.assert_equal(ys_cache, ys)
+        np.testing.assert_equal(shifts_cache, shifts)
+
+    assert len(list(tmp_path.glob('*.npy'))) == 2
+
+    # the second run only used the shifts, so the spectra are the least recently used
+    sizes = {fname.stat().st_size: fname for fname in tmp_path.glob('*.npy')}
+    ShiftsCache(tmp_path, max_size=min(sizes)).evict()
+    assert list(tmp_path.glob('*.npy')) == [sizes[min(sizes)]]
+
+
+@pytest.mark.parametrize("options", [{}, {'max_lag': 20, 'backend': 'direct'}, {'levels': 2}])
+def test_align_bundles_n_jobs(options):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    ys, shifts, template = align_bundles(bundles, return_shifts_matrix=True, block_size=1000, **options)
+
+    # each block is computed the same way whatever thread does it
+    for n_jobs in [2, -1]:
+        ys_jobs, shifts_jobs, template_jobs = align_bundles(bundles, return_shifts_matrix=True, block_size=1000,
+                                                            n_jobs=n_jobs, **options)
+        np.testing.assert_equal(ys_jobs, ys)
+        np.testing.assert_equal(shifts_jobs, shifts)
+        assert template_jobs == template
+
+
+@pytest.mark.parametrize("mode", ['full_template', 'half', 'full', 'everything', 2])
+def test_pair_indices(mode):
+    allpairs = [4, 0, 2, 7]
+    conditions = {'full_template': lambda i, j: True,
+                  'everything': lambda i, j: True,
+                  'half': lambda i, j: j > i,
+                  'full': lambda i, j: j != i,
+                  2: lambda i, j: i == 2 and j != 2}
+
+    expected = [(i, j) for i in allpairs for j in allpairs if conditions[mode](i, j)]
+    rows, cols = pair_indices(allpairs, mode)
+
+    assert filter_pairs(allpairs, mode) == expected
+    assert list(zip(rows, cols)) == expected
+
+    # the tiles are in the same order
+    tiles = list(iter_pairs(allpairs, mode, block_size=2))
+    assert len(tiles) > 1
+    np.testing.assert_equal(np.concatenate([tile[0] for tile in tiles]), rows)
+    np.testing.assert_equal(np.concatenate([tile[1] for tile in tiles]), cols)
+
+
+def test_align_bundles_metrics():
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    ys, shifts = align_bundles(bundles, truncation='shortest')
+
+    # an affine copy of a metric has the same shifts once whitened
+    stack = np.stack([bundles, np.where(bundles == 0, 0, 3 * bundles + 1), bundles**2])
+
+    for reference in [None, 0]:
+        ys_stack, shifts_stack = align_bundles(stack[:2], truncation='shortest', reference=reference)
+        np.testing.assert_allclose(shifts_stack, shifts, atol=1e-8)
+        np.testing.assert_allclose(ys_stack[0], ys, atol=1e-6)
+        np.testing.assert_allclose(ys_stack[1], np.where(np.isnan(ys), np.nan, 3 * ys + 1), atol=1e-5)
+
+    # every metric is shifted and truncated the same way
+    ys_stack, shifts_stack = align_bundles(stack, truncation='shortest', reference=2)
+    assert ys_stack.shape[:2] == stack.shape[:2]
+    np.testing.assert_equal(np.isnan(ys_stack[0]), np.isnan(ys_stack[2]))
+
+    with pytest.raises(ValueError):
+        align_bundles(stack, levels=2)
+
+
+def test_dpr_model(tmp_path):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    ys, shifts, template = align_bundles(bundles, truncation='shortest', num_points=80, return_shifts_matrix=True)
+
+    model = DPR(num_points=80)
+
+    with pytest.raises(ValueError):
+        model.transform(bundles)
+
+    np.testing.assert_equal(model.fit_transform(bundles), ys)
+    np.testing.assert_equal(model.shifts_, shifts[template])
+
+    # a loaded model realigns other metrics of the same bundles without fitting
+    fname = tmp_path / 'model.dpr'
+    model.save(fname)
+    model = DPR.load(fname)
+
+    assert model.template_ == template
+    np.testing.assert_equal(model.transform(bundles), ys)
+    np.testing.assert_allclose(model.transform(np.where(bundles == 0, 0, 2 * bundles)), 2 * ys, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        model.transform(bundles[1:])
+
+
+def test_align_bundles_memmap(tmp_path):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    np.save(tmp_path / 'bundles.npy', bundles)
+    mapped = np.load(tmp_path / 'bundles.npy', mmap_mode='r')
+
+    # the padding is removed in a copy, so the input file is not modified
+    for truncation in [None, 'shortest']:
+        ys, shifts = align_bundles(bundles, truncation=truncation)
+        ys_mapped, shifts_mapped = align_bundles(mapped, truncation=truncation, block_size=16, out=tmp_path / 'out.npy')
+
+        assert isinstance(ys_mapped, np.memmap)
+        np.testing.assert_equal(shifts_mapped, shifts)
+        np.testing.assert_equal(np.load(tmp_path / 'out.npy'), ys)
+
+    np.testing.assert_equal(mapped, bundles)
+
+    # a stack keeps its 3D shape in the output file
+    stack = np.stack([bundles, 2 * bundles])
+    out = np.zeros((2, len(bundles), 60))
+    model = DPR(num_points=60).fit(stack)
+    model.transform(stack, out=out)
+    model.transform(stack, out=tmp_path / 'stack.npy')
+
+    np.testing.assert_equal(out, model.transform(stack))
+    np.testing.assert_equal(np.load(tmp_path / 'stack.npy'), out)
+
+    with pytest.raises(ValueError):
+        model.transform(stack, out=np.zeros((2, len(bundles), 10)))
+
+    # out is filled through a 2D view, which a strided array can not give
+    with pytest.raises(ValueError):
+        model.transform(stack, out=np.zeros((len(bundles), 2, 60)).transpose(1, 0, 2))
+
+
+def test_flip_fibers():
+    template = np.array([[0, 0, 0], [5, 0, 0], [10, 0, 0]], dtype=np.float32)
+
+    # reversed, then in the same direction past the end of the template, which is not flipped
+    coordinates = [template, template[::-1], template + [10, 0, 0]]
+
+    bundles = np.array([[1, 2, 3, 4, 0, 0],
+                        [1, 0, 3, 4, np.nan, np.nan],
+                        [1, 2, 3, 4, 5, 6]])
+
+    flipped = flip_fibers(bundles, coordinates)
+    expected = np.array([[1, 2, 3, 4, 0, 0],
+                         [4, 3, 0, 1, np.nan, np.nan],
+                         [1, 2, 3, 4, 5, 6]])
+
+    np.testing.assert_equal(flipped, expected)
+    np.testing.assert_equal(flip_fibers(bundles, coordinates, padding=0.)[1], [4, 3, 0, 1, 0, 0])
+
+    with pytest.raises(ValueError):
+        flip_fibers(bundles, coordinates[:2])
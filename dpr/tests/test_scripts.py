@@ -1,4 +1,5 @@
 import subprocess
+import sys
 import pytest
 
 from pathlib import Path
@@ -21,3 +22,47 @@ def test_script_dpr(command):
 @pytest.mark.parametrize("command", commands_dpr_graph)
 def test_script_dpr_graph(command):
     subprocess.run(command, cwd=cwd, check=True)
+
+def test_script_dpr_batch(tmp_path):
+    manifest = tmp_path / 'manifest.csv'
+    report = tmp_path / 'report.csv'
+
+    with open(manifest, 'w') as f:
+        f.write('input,output,exploredti,points\n')
+        f.write(f'{cwd / "af_left_AFD.txt"},{tmp_path / "afd.txt"},true,75\n')
+        f.write(f'{cwd / "bundles.txt"},{tmp_path / "bundles.txt"},,\n')
+        f.write(f'{tmp_path / "missing.txt"},{tmp_path / "missing_realigned.txt"},,\n')
+        f.write(f'{cwd / "bundles.txt"},{tmp_path / "short.txt"}\n')
+        f.write(f'{cwd / "bundles.txt"}\n')
+
+    # the missing file and the row without an output fail, but the others are still done
+    process = subprocess.run(('dpr', 'batch', str(manifest), '--report', str(report), '--workers', '2'))
+    assert process.returncode == 1
+
+    assert (tmp_path / 'afd.txt').is_file()
+    assert (tmp_path / 'bundles.txt').is_file()
+    assert (tmp_path / 'short.txt').is_file()
+
+    with open(report) as f:
+        status = sorted(line.split(',')[2] for line in f.read().splitlines()[1:])
+
+    assert status == ['done', 'done', 'done', 'failed', 'failed']
+
+def test_script_dpr_update(tmp_path):
+    state = tmp_path / 'state.npz'
+    command = ('dpr', 'af_left_AFD.txt', str(tmp_path / 'afd.txt'), '--exploredti', '--update', str(state))
+    subprocess.run(command + ('-j', '2'), cwd=cwd, check=True)
+    assert state.is_file()
+
+    # the cohort is not aligned by align_bundles, so these options would have no effect
+    for option in [('--cache-dir', str(tmp_path / 'cache')), ('--reference', '0')]:
+        process = subprocess.run(command + ('-f',) + option, cwd=cwd, capture_output=True, text=True)
+        assert process.returncode == 2
+        assert 'can not be used with --update' in process.stderr
+
+def test_script_dpr_imports():
+    # the plotting stack and scipy are slow to import, so they should only be loaded when used
+    code = ('import sys, dpr.scripts.dpr, dpr.utils, dpr.register\n'
+            'heavy = [name for name in ["matplotlib", "mpl_toolkits", "scipy.ndimage", "scipy.fft"] if name in sys.modules]\n'
+            'assert not heavy, heavy')
+    subprocess.run((sys.executable, '-c', code), check=True)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from pathlib import Path
+from numpy.testing import assert_allclose, assert_equal
+
+from dpr.register import align_bundles
+from dpr.state import AlignmentState
+
+datasets = Path(__file__).parents[2] / Path("datasets")
+
+
+def test_incremental(tmp_path):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    ys, shifts, template = align_bundles(bundles, return_shifts_matrix=True)
+
+    state = AlignmentState().add(bundles[:60]).add(bundles[60:100])
+    fname = tmp_path / 'state.npz'
+    state.save(fname)
+    state = AlignmentState.load(fname).add(bundles[100:])
+
+    assert_equal(state.template, template)
+    assert_allclose(state.template_shifts, shifts[template], atol=1e-8)
+
+    # the state keeps the template row as computed, before the outliers were rematched
+    others = np.arange(len(bundles)) != template
+    assert_allclose(state.shifts.todense()[others][:, others], shifts[others][:, others], atol=1e-8)
+    assert_allclose(state.realign(), ys, atol=1e-8)
+
+
+def test_same_subjects(tmp_path):
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+    subjects = np.array([f'subject{i}' for i in range(len(bundles))])
+
+    state = AlignmentState().add(bundles[:60], subjects=subjects[:60])
+    template = state.template
+
+    # running the same update twice keeps a single copy of each subject
+    with pytest.warns(UserWarning, match='already in the cohort'):
+        state.add(bundles[:60], subjects=subjects[:60])
+
+    assert_equal(len(state.bundles), 60)
+    assert_equal(state.template, template)
+
+    with pytest.warns(UserWarning, match='already in the cohort'):
+        state.add(bundles[50:80], subjects=subjects[50:80])
+
+    assert_equal(state.subjects, subjects[:80])
+
+    with pytest.raises(ValueError, match='more than once'):
+        state.add(bundles[80:82], subjects=['subject80', 'subject80'])
@@ -0,0 +1,82 @@
+import pickle
+import numpy as np
+import pytest
+
+from pathlib import Path
+
+from dpr.register import flip_fibers
+from dpr.streamlines import Streamlines
+from dpr.utils import load_streamlines, read_per_line
+
+datasets = Path(__file__).parents[2] / Path("datasets")
+
+
+def test_read_streamlines():
+    fname = datasets / 'af_left_truncated_coordinates.txt'
+    streamlines = read_per_line(fname)
+
+    # the file is longer than the 50000 lines the old reader stopped at
+    text = fname.read_text().split('\n\n')
+    expected = [np.loadtxt(block.splitlines(), dtype=np.float32, ndmin=2) for block in text if block.strip()]
+
+    assert len(streamlines) == len(expected)
+    assert streamlines.points.shape == (sum(len(x) for x in expected), 3)
+
+    for streamline, x in zip(streamlines, expected):
+        np.testing.assert_equal(streamline, x)
+
+    np.testing.assert_equal(streamlines.first, [x[0] for x in expected])
+    np.testing.assert_equal(streamlines.last, [x[-1] for x in expected])
+    np.testing.assert_equal(streamlines.column(2)[-1], expected[-1][:, 2])
+
+
+def test_read_streamlines_blank_lines(tmp_path):
+    fname = tmp_path / 'coordinates.txt'
+
+    # extra blank lines are skipped and the last streamline does not need one
+    fname.write_text('\n1 2 3\n4 5 6\n\n\n7 8 9\n')
+    streamlines = Streamlines.read(fname)
+
+    np.testing.assert_equal(streamlines.lengths, [2, 1])
+    np.testing.assert_equal(streamlines[0], [[1, 2, 3], [4, 5, 6]])
+    np.testing.assert_equal(streamlines[1], [[7, 8, 9]])
+
+    fname.write_text('\n\n')
+    assert len(Streamlines.read(fname)) == 0
+
+
+def test_read_per_line_maxlines(tmp_path):
+    fname = tmp_path / 'coordinates.txt'
+    fname.write_text('1 2 3\n4 5 6\n\n7 8 9\n10 11 12\n\n')
+
+    # only the streamlines which end in the first lines are kept
+    np.testing.assert_equal(read_per_line(fname, maxlines=4).lengths, [2])
+    np.testing.assert_equal(read_per_line(fname, maxlines=6).lengths, [2, 2])
+    assert len(read_per_line(fname, maxlines=2)) == 0
+
+
+def test_save_load_streamlines(tmp_path):
+    streamlines = read_per_line(datasets / 'af_left_truncated_coordinates.txt')
+
+    fname = tmp_path / 'coordinates.npz'
+    streamlines.save(fname)
+    loaded = load_streamlines(fname)
+
+    np.testing.assert_equal(loaded.points, streamlines.points)
+    np.testing.assert_equal(loaded.lengths, streamlines.lengths)
+
+    with pytest.raises(ValueError):
+        Streamlines(streamlines.points, streamlines.lengths[1:])
+
+
+def test_flip_fibers_streamlines():
+    bundles = np.loadtxt(datasets / 'bundles.txt')
+
+    with open(datasets / 'coordinates.pkl', 'rb') as f:
+        coordinates = pickle.load(f)
+
+    flipped = flip_fibers(bundles, coordinates)
+    np.testing.assert_equal(flip_fibers(bundles, Streamlines.from_list(coordinates)), flipped)
+
+    with pytest.raises(ValueError):
+        flip_fibers(bundles, [x[:, :2] for x in coordinates])
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from pathlib import Path
+
+from dpr.utils import load_bundles, save_bundles, strip_header
+
+datasets = Path(__file__).parents[2] / Path("datasets")
+
+
+def test_strip_header():
+    fname = datasets / 'af_left_AFD.txt'
+    bundles, header = strip_header(fname)
+
+    np.testing.assert_equal(bundles, np.genfromtxt(fname, usecols=range(1, bundles.shape[1] + 1)))
+    np.testing.assert_equal(header, np.genfromtxt(fname, dtype=str, usecols=0))
+
+
+@pytest.mark.parametrize("ext", ['.txt', '.csv', '.npy', '.npz'])
+def test_save_load_bundles(tmp_path, ext):
+    bundles, header = strip_header(datasets / 'af_left_AFD.txt')
+    bundles[:, -10:] = np.nan
+
+    fname = tmp_path / f'bundles{ext}'
+    save_bundles(fname, bundles, subjects=header)
+    loaded, subjects = load_bundles(fname, exploredti=ext in ['.txt', '.csv'])
+
+    np.testing.assert_equal(loaded, bundles)
+
+    if ext == '.npy':
+        assert subjects is None
+    else:
+        np.testing.assert_equal(subjects, header)
+
+    # the numbers are written as str would, without the subjects
+    if ext == '.txt':
+        save_bundles(fname, bundles[:2])
+        lines = fname.read_text().splitlines()
+        assert lines == [' '.join(str(x) for x in row) for row in bundles[:2]]
+
+
+@pytest.mark.parametrize("exploredti", [True, False])
+def test_load_bundles_empty_cells(tmp_path, exploredti):
+    fname = tmp_path / 'bundles.csv'
+    lines = ['1,2,3,4', '5,,7,', '8,9,,']
+
+    # padded cohorts usually leave the cells after the end of a bundle empty
+    if exploredti:
+        lines = [f's{idx},{line}' for idx, line in enumerate(lines)]
+
+    fname.write_text('\n'.join(lines) + '\n')
+    bundles, subjects = load_bundles(fname, exploredti=exploredti)
+
+    np.testing.assert_equal(bundles, [[1, 2, 3, 4], [5, np.nan, 7, np.nan], [8, 9, np.nan, np.nan]])
+
+    if exploredti:
+        np.testing.assert_equal(subjects, ['s0', 's1', 's2'])
+    else:
+        assert subjects is None
@@ -1,35 +1,30 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+from dpr.streamlines import Streamlines
 
 
-def read_per_line(fname, maxlines=50000):
+def read_per_line(fname, maxlines=None):
+    '''
+    Reads a text file with one point per line and a blank line after each streamline.
 
-    array = []
-    new_line = []
-    nlines = 0
+    maxlines - only read the streamlines in the first maxlines lines, or the whole file if None
 
-    with open(fname, 'r') as file:
-        for line in file:
-            # empty line, so we read the whole track and must start a new one
-            if line in ['\n', '\r\n']:
-                array.append(np.array(new_line, dtype=np.float32))
-                new_line = []
-            else:
-                this_line = line.strip()
+    Returns a dpr.streamlines.Streamlines, which is indexed like the list of arrays of each streamline.
+    '''
+    return Streamlines.read(fname, maxlines=maxlines)
 
-                # we have more than one coordinate per line, such as a position xyz
-                if len(this_line.split()) > 1:
-                    this_line = np.array([float(x) for x in this_line.split()])
 
-                new_line.append(this_line)
+def load_streamlines(fname):
+    '''
+    Reads the streamlines from a .npz file of Streamlines.save or a text file as in read_per_line.
+    '''
+    _, ext = os.path.splitext(fname)
 
-            if nlines >= maxlines:
-                break
-            nlines += 1
+    if ext == '.npz':
+        return Streamlines.load(fname)
 
-    return array
+    return Streamlines.read(fname)
 
 
 def strip_first_col(fname, delimiter=None):
@@ -42,65 +37,117 @@ def strip_first_col(fname, delimiter=None):
 
 
 def strip_header(filename, columns=0, delimiter=None):
-    header = np.genfromtxt(filename, dtype=str, usecols=columns, delimiter=delimiter)
+    '''
+    Reads a text file with the name of each subject in one column, such as the ones of ExploreDTI, in a single pass.
+
+    Returns the bundles and the name of each subject.
+    '''
+    names = []
+    lines = []
+
     with open(filename, 'r') as file:
-        ncols = len(file.readline().split(delimiter))
-    bundles = np.genfromtxt(filename, usecols=range(1, ncols), delimiter=delimiter)
-    return bundles, header
+        for line in file:
+            fields = line.split(delimiter, columns + 1)
+
+            # empty line or only a name
+            if len(fields) <= columns + 1:
+                continue
+
+            names.append(fields[columns])
+            lines.append((delimiter or ' ').join(fields[:columns] + fields[columns + 1:]))
+
+    # the numbers are all parsed at once by numpy
+    bundles = _read_numbers(lines, delimiter=delimiter)
+    return bundles, np.array(names, dtype=str)
+
+
+def _read_numbers(fname, delimiter=None):
+    '''
+    np.loadtxt, which is much faster, but falls back to np.genfromtxt for the empty cells of a csv file, which are nan.
+    '''
+    try:
+        return np.loadtxt(fname, delimiter=delimiter, ndmin=2)
+    except ValueError:
+        return np.atleast_2d(np.genfromtxt(fname, delimiter=delimiter))
+
+
+def load_bundles(fname, exploredti=False, mmap_mode=None):
+    '''
+    Reads the bundles from a .npy, .npz, .csv or text file, picked from the extension.
+
+    fname - a .npz file has the bundles and, optionally, the name of each subject as in save_bundles
+    exploredti - if True, the first column of a text file is the name of each subject
+    mmap_mode - a .npy file is memory mapped with this mode of np.load instead of being read in memory
+
+    Returns the bundles and the name of each subject, or None if there are none.
+    '''
+    _, ext = os.path.splitext(fname)
+
+    if ext == '.npy':
+        return np.load(fname, mmap_mode=mmap_mode), None
+
+    if ext == '.npz':
+        with np.load(fname) as data:
+            subjects = data['subjects'] if 'subjects' in data else None
+            return data['bundles'], subjects
 
+    if ext == '.csv':
+        delimiter = ','
+    else:
+        delimiter = None
 
-# Actual colors I used in the manuscript
-blue = np.array([0.6093924, 0.73212757, 0.82249106])
-green = np.array([0.22953434, 0.57685998, 0.42976558])
+    if exploredti:
+        return strip_header(fname, delimiter=delimiter)
 
+    return _read_numbers(fname, delimiter=delimiter), None
 
-def colorbar(mappable):
-    ax = mappable.axes
-    fig = ax.figure
-    divider = make_axes_locatable(ax)
-    cax = divider.append_axes("right", size="5%", pad=0.05)
-    return fig.colorbar(mappable, cax=cax)
 
+def save_bundles(fname, bundles, subjects=None):
+    '''
+    Writes the bundles to a .npy, .npz, .csv or text file, picked from the extension.
 
-def draw_fancy_graph(pval, coords1, coords2, truncated_coords1, truncated_coords2, average1, average2, coord1_label='X', coord2_label='Y',
-                     pval_threshold=1., pval_cmap=plt.cm.hot, mean_fiber_cmap=green, bundle_cmap=blue,
-                     shadow_cmap='gray', title=None, draw_colorbar=True):
+    subjects - name of each subject, which are stored alongside the bundles in a .npz file
+        or as the first column of a text file, but not in a .npy file
+    '''
+    _, ext = os.path.splitext(fname)
 
-    if title is None:
-        title = 'p-values after realignment'
+    if ext == '.npy':
+        np.save(fname, bundles)
+        return
 
-    fig, ax = plt.subplots(1, 1, sharex='col', sharey='row', figsize=(8, 8))
+    if ext == '.npz':
+        arrays = {'bundles': bundles}
 
-    # Draw the full length shadow bundle
-    for x, y in zip(coords1, coords2):
-        ax.plot(x, y, color=shadow_cmap, alpha=0.1, zorder=1)
+        if subjects is not None:
+            arrays['subjects'] = np.asarray(subjects, dtype=str)
 
-    # Draw the original coord, but truncated between rois
-    for x, y in zip(truncated_coords1, truncated_coords2):
-        ax.plot(x, y, color=bundle_cmap, alpha=0.3, zorder=2)
+        # a file object prevents numpy from adding .npz to the name
+        with open(fname, 'wb') as file:
+            np.savez(file, **arrays)
+        return
 
-    # Draw the mean coord
-    x = average1
-    y = average2
-    ax.plot(x, y, color=mean_fiber_cmap, zorder=5)
+    if ext == '.csv':
+        delimiter = ','
+    else:
+        delimiter = ' '
 
-    # We resample the pvals because the coords may be at the tracking stepsize and the final results at the voxel resolution
-    old = np.arange(len(pval)) / len(pval)
-    new = np.arange(len(x)) / len(x)
-    pval_resampled = np.interp(new, old, pval)
+    # each number is written as its shortest repr, like str, without going through an array of strings or objects
+    with open(fname, 'w') as file:
+        if subjects is None:
+            for row in np.asarray(bundles).tolist():
+                file.write(delimiter.join(map(str, row)) + '\n')
+        else:
+            for subject, row in zip(subjects, np.asarray(bundles).tolist()):
+                file.write(delimiter.join([str(subject)] + list(map(str, row))) + '\n')
 
-    # This makes everything above the threshold invisible on the final graph
-    pval_resampled[pval_resampled > pval_threshold] = np.nan
-    cmap_axis = ax.scatter(x, y, c=pval_resampled, cmap=pval_cmap, zorder=10, marker='.', vmin=0, vmax=pval_threshold)
 
-    if draw_colorbar:
-        colorbar(cmap_axis)
+# the plotting functions used to live here, they are now only loaded when needed so reading files stays light
+_plotting = ['blue', 'green', 'colorbar', 'draw_fancy_graph']
 
-    ax.axis('equal')
-    ax.set_xlabel(f"{coord1_label} coordinates (mm)", fontsize=12)
-    ax.set_ylabel(f"{coord2_label} coordinates (mm)", fontsize=12)
 
-    ax.set_title(title, fontsize=20)
-    fig.tight_layout()
+def __getattr__(name):
+    if name in _plotting:
+        from dpr import plotting
+        return getattr(plotting, name)
 
-    return fig, ax
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')